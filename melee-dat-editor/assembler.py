@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Text assembly language for subaction scripts, for editing them in bulk
+outside of the editor.
+
+Each event is one indented line: the event name, then a colon and the fields
+as name=value pairs.
+
+    Create Hitbox: ID=0, Unknown 1=0, Bone=0x35, Damage=12, ...
+
+Field names are matched the same way Event.__getitem__ matches them, and
+fields that are left out are zero. An event that can't be written this way
+(an event type whose name is shared with another one, or bits that aren't
+part of any field) is written as its hex value instead, like 0x04000001.
+
+Each script starts with an unindented header line, either
+``subaction <numbers> [@label]`` for the script of one or more subactions
+(which must all be sharing it) or ``script <offset> @label`` for a script at
+a data offset, such as a subroutine. Subroutine and goto targets can be given
+as @label instead of an offset. Everything after a # is a comment.
+"""
+
+from collections import defaultdict, deque, namedtuple
+
+from inplace_tables import ShiftMap
+import script
+
+
+Block = namedtuple('Block', 'subactions offset label events references')
+Block.__doc__ = """
+One script from the assembly. `subactions` is a tuple of the subaction
+numbers the script is for, or empty for a script at data offset `offset`.
+`references` lists (event index, byte offset of the pointer in the event,
+label) for each target given as a label.
+"""
+
+_mnemonics = {}
+_pointer_fields = {}
+_exact_masks = {}
+
+
+def mnemonics(script_type=script.FIGHTER):
+    """
+    Returns a dict of normalized event name -> (code, custom code), for each
+    event name that only one event type has.
+    """
+    try:
+        return _mnemonics[script_type]
+    except KeyError:
+        pass
+    found = defaultdict(list)
+    for base_code, types in script.event(script_type).event_types.items():
+        if not isinstance(base_code, int):  # 'default'
+            continue
+        for code, evtype in types.items():
+            found[script.normalize_fieldname(evtype['name'])].append(
+                    (base_code, code))
+    table = {name: codes[0] for name, codes in found.items()
+             if len(codes) == 1}
+    _mnemonics[script_type] = table
+    return table
+
+
+def pointer_fields(event_class):
+    """Returns a dict of field index -> pointer offset in the event, for the
+    fields of an event class that are pointers"""
+    try:
+        return _pointer_fields[event_class]
+    except KeyError:
+        pass
+    fields = {}
+    for p in event_class.pointers:
+        if p is None:
+            continue
+        for i, (shift, _, bit_length, _) in enumerate(event_class._accessors):
+            if bit_length == 32 and event_class._nbits - shift == 8*p + 32:
+                fields[i] = p
+    _pointer_fields[event_class] = fields
+    return fields
+
+
+def _exact_mask(event_class):
+    """Bits of an event that are rebuilt from its name and fields"""
+    try:
+        return _exact_masks[event_class]
+    except KeyError:
+        pass
+    blank = event_class._family.blank(*event_class._code)
+    mask = blank._data
+    for shift, field_mask, _, _ in event_class._accessors:
+        mask |= field_mask << shift
+    _exact_masks[event_class] = mask
+    return mask
+
+
+def _can_name(ev, script_type):
+    name = script.normalize_fieldname(ev.name)
+    if mnemonics(script_type).get(name) != tuple(ev.code):
+        return False
+    if ev._data & ~_exact_mask(type(ev)):
+        return False
+    # NaN payloads don't survive being written out as 'nan'
+    return not any(value != value for value in ev)
+
+
+def format_event(ev, labels=None, script_type=script.FIGHTER):
+    """
+    Returns the line of assembly for event `ev`. `labels` maps pointer values
+    (data offsets) to the labels to write for them.
+    """
+    if not _can_name(ev, script_type):
+        return '0x' + bytes(ev).hex()
+    pointers = pointer_fields(type(ev))
+    values = []
+    for i, (name, value) in enumerate(zip(ev.fieldnames(), ev.str_values())):
+        if labels and i in pointers and ev[i] in labels:
+            value = '@' + labels[ev[i]]
+        values.append(f'{name}={value}')
+    if not values:
+        return ev.name
+    return ev.name + ': ' + ', '.join(values)
+
+
+def disassemble(events, labels=None, script_type=script.FIGHTER,
+                indent='    '):
+    """Returns a list of lines of assembly, one for each event"""
+    return [indent + format_event(ev, labels, script_type) for ev in events]
+
+
+def parse_event(line, script_type=script.FIGHTER):
+    """
+    Parse one line of assembly into an event. Returns the event and a list of
+    (pointer offset, label) for the fields given as labels, which are left as
+    zero in the event.
+    """
+    cls = script.event(script_type)
+    line = line.strip()
+    if line.lower().startswith('0x'):
+        return cls.from_hex(line), []
+    eq = line.find('=')
+    if eq < 0:
+        name, fields = line, ''
+    else:
+        # event names can have colons in them, so take the last one
+        colon = line.rfind(':', 0, eq)
+        if colon < 0:
+            raise ValueError(f"Expected ':' after the event name in '{line}'")
+        name, fields = line[:colon], line[colon+1:]
+    try:
+        code = mnemonics(script_type)[script.normalize_fieldname(name)]
+    except KeyError:
+        raise ValueError(f"Unknown event '{name.strip()}'") from None
+    ev = cls.blank(*code)
+    pointers = pointer_fields(type(ev))
+    references = []
+    for item in fields.split(','):
+        if not item.strip():
+            continue
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError(f"Expected field=value, got '{item.strip()}'")
+        index = ev._try_fieldname_to_index(key.strip())
+        value = value.strip()
+        if value.startswith('@'):
+            if index not in pointers:
+                raise ValueError(f"Field '{key.strip()}' can't be a label")
+            references.append((pointers[index], value[1:]))
+        elif ev._accessors[index][3] in ('f', 'f-upper'):
+            ev[index] = float(value)
+        else:
+            ev[index] = int(value, 0)
+    return ev, references
+
+
+def _parse_header(line):
+    kind, _, rest = line.strip().partition(' ')
+    rest, _, label = rest.partition('@')
+    label = label.strip() or None
+    numbers = [int(n, 0) for n in rest.replace(',', ' ').split()]
+    if kind.lower() == 'subaction' and numbers:
+        return Block(tuple(numbers), None, label, [], [])
+    if kind.lower() == 'script' and len(numbers) == 1 and label:
+        return Block((), numbers[0], label, [], [])
+    raise ValueError(f"Expected 'subaction <numbers> [@label]' or "
+                     f"'script <offset> @label', got '{line.strip()}'")
+
+
+def parse(lines, script_type=script.FIGHTER):
+    """
+    Parse assembly from an iterable of lines, such as an open file, a line at
+    a time. Yields a Block for each script. ValueError is raised for anything
+    that can't be parsed, with the line number.
+    """
+    block = None
+    for number, line in enumerate(lines, 1):
+        text = line.split('#', 1)[0].rstrip()
+        if not text:
+            continue
+        try:
+            if not text[0].isspace():
+                new_block = _parse_header(text)
+            else:
+                new_block = None
+                if block is None:
+                    raise ValueError('Event before the first script header')
+                ev, references = parse_event(text, script_type)
+                block.references.extend((len(block.events), p, label)
+                                        for p, label in references)
+                block.events.append(ev)
+        except ValueError as e:
+            raise ValueError(f'Line {number}: {e}') from None
+        if new_block is not None:
+            if block is not None:
+                yield block
+            block = new_block
+    if block is not None:
+        yield block
+
+
+def resolve(block, targets):
+    """Returns a copy of the block's events with the labels filled in from
+    `targets`, a dict of label -> data offset"""
+    events = [ev.copy() for ev in block.events]
+    for i, p, label in block.references:
+        try:
+            target = targets[label]
+        except KeyError:
+            raise ValueError(f"Undefined label '@{label}'") from None
+        ev = events[i]
+        for index, offset in pointer_fields(type(ev)).items():
+            if offset == p:
+                ev[index] = target
+    return events
+
+
+def _script_tree(f):
+    """Returns {subaction number: script offset} for moveset dat file `f`,
+    and the set of offsets called or gone to from those scripts"""
+    roots = {i: f.pointer(subaction.script_pointer)
+             for i, subaction in f.iter_subactions()}
+    targets = set()
+    queue = deque(roots.values())
+    seen = set()
+    while queue:
+        offset = queue.popleft()
+        if offset in seen:
+            continue
+        seen.add(offset)
+        found = f.script_targets(offset)
+        targets.update(found)
+        queue.extend(found)
+    return roots, targets
+
+
+def disassemble_file(f):
+    """
+    Returns a list of lines of assembly for every subaction script in
+    moveset dat file `f` and every script they call or go to.
+    """
+    roots, targets = _script_tree(f)
+    labels = {offset - f.header_size: f'loc_{offset - f.header_size:X}'
+              for offset in targets}
+    lines = []
+    sharing = defaultdict(list)  # script offset -> subaction numbers
+    for i, offset in roots.items():
+        sharing[offset].append(i)
+    for offset, numbers in sharing.items():
+        header = 'subaction ' + ', '.join(f'{i:#x}' for i in numbers)
+        label = labels.get(offset - f.header_size)
+        if label is not None:
+            header += ' @' + label
+        name = f.subaction_short_name(numbers[0])
+        if name:
+            header += '  # ' + name
+        lines.append(header)
+        lines.extend(disassemble(f.script_at(offset), labels))
+        lines.append('')
+    for offset in sorted(targets - set(roots.values())):
+        data_offset = offset - f.header_size
+        lines.append(f'script {data_offset:#x} @{labels[data_offset]}')
+        lines.extend(disassemble(f.script_at(offset), labels))
+        lines.append('')
+    return lines
+
+
+def assemble_file(f, lines):
+    """
+    Replace the scripts in moveset dat file `f` with the ones in the assembly
+    `lines` (an iterable of lines, such as an open file). Scripts that come
+    out the same as what's already there are left alone. Returns the number
+    of scripts that were replaced.
+
+    Offsets in the assembly, including targets given as numbers, are offsets
+    in the file as it was before any script was replaced.
+    """
+    blocks = list(parse(lines))
+    starts = []
+    for block in blocks:
+        if block.subactions:
+            offsets = {f.get_subaction(i).script_pointer
+                       for i in block.subactions}
+            if len(offsets) > 1:
+                raise ValueError(f"Subactions {block.subactions} don't "
+                                 f"share a script")
+            starts.append(f.pointer(offsets.pop()))
+        else:
+            starts.append(f.pointer(block.offset))
+    label_blocks = {}
+    for i, block in enumerate(blocks):
+        if block.label is not None:
+            if block.label in label_blocks:
+                raise ValueError(f"Label '@{block.label}' is defined twice")
+            label_blocks[block.label] = i
+    replaced = 0
+    # every resize so far, for moving targets given as numbers
+    moved = ShiftMap()
+    for i, block in enumerate(blocks):
+        targets = {label: starts[j] - f.header_size
+                   for label, j in label_blocks.items()}
+        events = resolve(block, targets)
+        if moved:
+            labelled = {(j, p) for j, p, label in block.references}
+            for j, ev in enumerate(events):
+                for index, p in pointer_fields(type(ev)).items():
+                    if (j, p) not in labelled:
+                        ev[index] = (moved(f.pointer(ev[index]))
+                                     - f.header_size)
+        new_bytes = b''.join(bytes(ev) for ev in events)
+        old_bytes = b''.join(bytes(ev) for ev, offset
+                             in f.decode_script_at(starts[i]))
+        if new_bytes == old_bytes:
+            continue
+        shift_map = f.replace_script_at(starts[i], events)
+        starts = [shift_map(start) for start in starts]
+        # the locations are from before this replace, but add() takes them
+        # after the shifts in front of them
+        for location, amount, total in zip(shift_map.locations,
+                                           shift_map.amounts,
+                                           shift_map.totals):
+            moved.add(location + total, amount)
+        replaced += 1
+    return replaced
+
+
+def dump(f, fname):
+    """Write the assembly for every script in `f` to the text file `fname`"""
+    with open(fname, 'w') as out:
+        out.write('\n'.join(disassemble_file(f)))
+
+
+def load(f, fname):
+    """Replace the scripts in `f` with the ones in the text file `fname`"""
+    with open(fname) as src:
+        return assemble_file(f, src)
@@ -6,7 +6,8 @@ Created on Wed Jan  9 20:41:47 2019
 """
 
 import os
-import yaml
+
+import yaml_cache
 
 
 common_folder = os.path.join('data', 'attributes', 'common')
@@ -16,7 +17,7 @@ unique_folder = os.path.join('data', 'attributes', 'unique')
 def article_info(character_short_name):
     try:
         fname = os.path.join(unique_folder, character_short_name + '.yml')
-        return yaml.safe_load(open(fname, 'r'))['articles']
+        return yaml_cache.load(fname)['articles']
     except OSError:
         raise
     except IndexError:
@@ -42,7 +43,7 @@ def unique_table(character_short_name):
 
 
 def get_table(fname, key=None):
-    data = yaml.safe_load(open(fname, 'r'))
+    data = yaml_cache.load(fname)
     if key is not None:
         data = data[key]
     try:
@@ -53,13 +53,7 @@ for character, attributes in ch_dump_data.items():
     with moveset_datfile(dat_fname) as dat_f:
         character_name = dat_f.char_short_name()
         start_offset = dat_f.unique_attributes_table.start_offset
-        next_pointer = 99999999999999999999999
-        for p in dat_f.pointer_table:
-            dat_f.seek(dat_f.pointer(p))
-            pointed = dat_f.pointer(dat_f.read_int())
-            if start_offset < pointed < next_pointer:
-                next_pointer = pointed
-        length = next_pointer - start_offset
+        length = dat_f.block_size(start_offset)
 
     with open(os.path.join(attribs_folder, character_name + '.yml'), 'w') as f:
         f.write('length: ' + hex(length) + '\n\n')
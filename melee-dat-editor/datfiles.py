@@ -5,21 +5,58 @@ Created on Tue Oct  9 11:43:43 2018
 @author: rmn
 """
 
-from collections import namedtuple
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
+import os
 from os import SEEK_CUR
 import struct
-from tempfile import TemporaryFile
+
+try:
+    import numpy as np
+except ImportError:  # optional, only used to speed up pointer relocation
+    np = None
 
 import attributes
-from inplace_tables import (HasInPlaceTables, preserve_pos, follow_chain, at,
-                            NamedStruct)
+from inplace_tables import (HasInPlaceTables, preserve_pos, follow_chain,
+                            lazy_property, NamedStruct, ShiftMap)
 import script
+from storage import MemoryStorage, open_storage, splice
 
 
 Int = struct.Struct('>I')
 
 ALIGN_PADDING = 0xDEADBEEF
 
+Header = struct.Struct('>IIIII')
+
+ModelNodes = namedtuple('ModelNodes', 'jobjs dobjs mobjs tobjs image_headers '
+                                      'images')
+
+
+def header_value(index):
+    """
+    Make a property for one of the header values. The header is decoded once
+    and kept in BaseDatFile._header; setting a value writes it through to the
+    file as well.
+    """
+    def getter(self):
+        if self._header is None:
+            self._header = list(Header.unpack(self.peek_at(0, Header.size)))
+        return self._header[index]
+
+    @preserve_pos
+    def setter(self, value):
+        getter(self)
+        header = list(self._header)
+        header[index] = value
+        self.seek(4*index)
+        self.write(Int.pack(value))  # this clears the cache...
+        self._header = header  # ...so put the updated copy back afterwards
+    return property(getter, setter)
+
+
 def moveset_datfile(fname, mode='r+b', copy=True):
     new = MovesetDatFile(fname, mode, copy)
     if new.char_short_name() == 'Kirby':
@@ -33,13 +70,13 @@ class BaseDatFile (HasInPlaceTables):
 
     header_size = 0x20
 
-    # header values. These are magical and will read from the file whenever
-    # accessed, and will write to the file whenever modified.
-    file_size = at(0)
-    data_size = at(4)
-    n_pointers = at(8)
-    root_node_count = at(0xC)
-    ref_node_count = at(0x10)
+    # header values. These are read from the file once and cached, and will
+    # write to the file whenever modified.
+    file_size = header_value(0)
+    data_size = header_value(1)
+    n_pointers = header_value(2)
+    root_node_count = header_value(3)
+    ref_node_count = header_value(4)
 
     @property
     def index_offset(self):
@@ -50,18 +87,22 @@ class BaseDatFile (HasInPlaceTables):
 
     def __init__(self, fname, mode='r+b', copy=True):
         super().__init__()
-        self.aligned_offsets = []
-        if copy:
-            with open(fname, 'rb') as file:
-                self.f = TemporaryFile()
-                self.f.write(file.read())
-                self.f.seek(0)
-        else:
-            self.f = open(fname, mode)
-        self.pointer_table = self.inplace_table(
+        self._aligned_offsets = None  # found on first use, see find_aligned_offsets
+        self._pending_shifts = None  # ShiftMap while a transaction is open
+        # bumped by every write and insert, so cached views of the data know
+        # when they are out of date
+        self.edit_generation = 0
+        self._target_index = None
+        # pointers that may have been overwritten since the index saw them
+        self._stale_pointers = set()
+        self._header = None
+        # unused bytes in the data section, see FreeSpaceMap
+        self.free_space = FreeSpaceMap()
+        # copy=True keeps the whole file in memory, see storage.py
+        self.f = open_storage(fname, mode, copy)
+        self.pointer_table = self.inplace_int_table(
                 self.data_size+self.header_size,
-                self.n_pointers,
-                Int)
+                self.n_pointers)
         Node = NamedStruct('>II', 'Node', 'pointer str_pointer')
         self.root_nodes = self.inplace_table(
                 self.header_size + self.data_size + 4*self.n_pointers,
@@ -82,10 +123,58 @@ class BaseDatFile (HasInPlaceTables):
     def peek(self, amount):
         return self.read(amount)
 
+    @preserve_pos
+    def peek_at(self, offset, amount):
+        self.seek(offset)
+        return self.read(amount)
+
+    def read_struct(self, offset, struct):
+        """
+        Decode `struct` at raw file offset `offset`. Unlike inplace_struct,
+        this is a one-off copy that isn't kept up to date with later edits.
+        """
+        return struct.unpack(self.peek_at(offset, struct.size))
+
     def __getattr__(self, name):
         # delegate to the internal file object
         return getattr(self.f, name)
 
+    def write(self, data):
+        start = self.tell()
+        self.data_changed(start, start + len(data))
+        return self.f.write(data)
+
+    def data_changed(self, start, end=None):
+        """
+        Called whenever bytes `start` to `end` of the file are changed, or
+        with end=None when an insert or delete at `start` moves everything
+        after it. Drops anything cached about that part of the file.
+        """
+        self.edit_generation += 1
+        if self._target_index is not None:
+            self._pointers_changed(start, end)
+        if start < Header.size:
+            self._header = None
+
+    def _pointers_changed(self, start, end):
+        hs = self.header_size
+        if self._pending_shifts:
+            # the index can't follow the edits inside a transaction once
+            # anything has moved
+            self._target_index = None
+        elif end is None:
+            # an insert: read what was overwritten before anything moves,
+            # and relocate_pointers moves the index along with the pointers
+            self._read_stale_pointers()
+        elif start < hs + self.data_size and end > hs:
+            values = self.pointer_table.values
+            if not self.pointer_table.is_sorted:
+                self._target_index = None
+                return
+            i = bisect_left(values, start - hs - 3)
+            j = bisect_left(values, end - hs)
+            self._stale_pointers.update(values[i:j])
+
     def __enter__(self):
         return self
 
@@ -95,33 +184,132 @@ class BaseDatFile (HasInPlaceTables):
     def delete_pointer(self, pointer_value):
         self.pointer_table.delete_by_value(pointer_value)
         self.n_pointers -= 1
+        self._stale_pointers.add(pointer_value)
 
     def add_pointer(self, pointer_value):
         self.pointer_table.insert_sorted(pointer_value)
         self.n_pointers += 1
+        self._stale_pointers.add(pointer_value)
 
     def is_valid_pointer(self, pointer_val):
         return pointer_val - self.header_size in self.pointer_table
 
-    @preserve_pos
     def adjust_pointers(self, location, amount):
-        for i, p in enumerate(self.pointer_table):
-            if p + self.header_size >= location:
-                self.pointer_table[i] += amount
-            if not self.pointer_table.start_offset < location < self.pointer_table.end_offset:
-                # this "am I in the pointer table" check is here to prevent
-                # a bug where __delitem__ on the pointer table would
-                # decrement the pointer in the data section by 4 as it was
-                # removed from the pointer list
-                self.seek(p + self.header_size)
-                val = Int.unpack(self.read(4))[0]
-                if val + self.header_size >= location:
-                    self.seek(-4, SEEK_CUR)
-                    self.write(Int.pack(val + amount))
+        self.relocate_pointers(ShiftMap(location, amount))
+
+    @preserve_pos
+    def relocate_pointers(self, shift_map):
+        """
+        Update the relocation table, every pointer it lists and the root/ref
+        nodes according to `shift_map`, which maps offsets from before a set
+        of inserts to offsets after them. The data itself must already have
+        been moved.
+        """
+        if not self._relocate_pointers_vectorized(shift_map):
+            self._relocate_pointers_loop(shift_map)
         for table in (self.root_nodes, self.ref_nodes):
             for i, node in enumerate(table):
-                if node[0] > location:
-                    table[i, 0] += amount
+                # unlike pointers, a node pointing right at an insert stays
+                # where it is, so data inserted at the start of a node's
+                # table becomes part of it
+                new_val = (shift_map(self.pointer(node[0]) - 1) + 1
+                           - self.header_size)
+                if new_val != node[0]:
+                    table[i, 0] = new_val
+        if self._target_index is not None:
+            # the pointers written above are all accounted for by the shift
+            self._stale_pointers = set(self._target_index.shift(
+                    lambda offset: (shift_map(self.pointer(offset))
+                                    - self.header_size),
+                    lambda offset: shift_map.is_deleted(self.pointer(offset))))
+
+    def _relocate_pointers_loop(self, shift_map):
+        for i, p in enumerate(self.pointer_table):
+            new_p = shift_map(self.pointer(p)) - self.header_size
+            if new_p != p:
+                self.pointer_table[i] = new_p
+            if shift_map.is_deleted(self.pointer(p)):
+                # the pointer itself was deleted, so whatever is at new_p now
+                # is some other data that must be left alone
+                continue
+            self.seek_pointer(new_p)
+            val = self.read_int()
+            new_val = shift_map(self.pointer(val)) - self.header_size
+            if new_val != val:
+                self.seek(-4, SEEK_CUR)
+                self.write(Int.pack(new_val))
+
+    def _relocate_pointers_vectorized(self, shift_map):
+        """
+        Same as _relocate_pointers_loop, but done with numpy directly on the
+        in-memory buffer: the relocation table and the pointed-to words are
+        loaded as uint32 arrays, shifted in bulk and written back with one
+        write each. Returns False (having changed nothing) if numpy isn't
+        available or the file can't be handled this way.
+        """
+        if np is None or not isinstance(self.f, MemoryStorage):
+            return False
+        hs = self.header_size
+        locations = np.array(shift_map.locations, dtype=np.int64)
+        amounts = np.array(shift_map.amounts, dtype=np.int64)
+        totals = np.array(shift_map.totals, dtype=np.int64)
+
+        def shift(offsets):
+            return offsets + totals[np.searchsorted(locations, offsets,
+                                                    side='right')]
+
+        old_p = np.frombuffer(self.pointer_table.values,
+                              dtype=np.uint32).astype(np.int64) + hs
+        new_p = shift(old_p)
+        i = np.searchsorted(locations, old_p, side='right') - 1
+        deleted = ((i >= 0) & (amounts[i] < 0)
+                   & (old_p < locations[i] - amounts[i]))
+        live = new_p[~deleted]
+        if (np.any(live % 4) or np.any(live < hs)
+                or np.any(live + 4 > hs + self.data_size)):
+            return False
+
+        with self.f.getbuffer() as buf:
+            words = np.frombuffer(buf, dtype='>u4', offset=hs,
+                                  count=self.data_size//4)
+            index = (live - hs) // 4
+            values = words[index].astype(np.int64)
+            new_values = shift(values + hs) - hs
+            changed = new_values != values
+            words[index[changed]] = new_values[changed]
+            del words
+        if np.any(changed):
+            start = hs + 4*int(index[changed].min())
+            end = hs + 4*int(index[changed].max()) + 4
+            self.f.mark_dirty(start, end)
+            self.data_changed(start, end)
+        if np.any(new_p != old_p):
+            self.pointer_table.assign(
+                    array('I', (new_p - hs).astype(np.uint32).tobytes()))
+        return True
+
+    @contextmanager
+    def transaction(self):
+        """
+        Defer pointer relocation until the end of a `with` block.
+
+        Inserts made inside the block move the data and update header values
+        and in-place tables right away, but the pointers are all relocated in
+        one pass when the block exits, instead of once per insert. Until
+        then, pointer values and the relocation table still hold the offsets
+        from before the block, so don't read or write pointers inside it.
+        Nested transactions join the outermost one.
+        """
+        if self._pending_shifts is not None:
+            yield self
+            return
+        self._pending_shifts = ShiftMap()
+        try:
+            yield self
+        finally:
+            shift_map, self._pending_shifts = self._pending_shifts, None
+            if shift_map:
+                self.relocate_pointers(shift_map)
 
 #    def next_pointer(self, location):
 #        """
@@ -136,17 +324,247 @@ class BaseDatFile (HasInPlaceTables):
 #                found = p
 #        return found
 
+    @property
+    def target_index(self):
+        """
+        _TargetIndex of every pointer in the relocation table. Built the
+        first time it's needed, then moved along with every relocation and
+        updated for pointers that are added, deleted or written over. Edits
+        inside a transaction make it get rebuilt on the next access.
+        """
+        if self._target_index is None:
+            self._target_index = _TargetIndex(self.pointer_targets())
+            self._stale_pointers = set()
+        else:
+            self._read_stale_pointers()
+        return self._target_index
+
+    @preserve_pos
+    def _read_stale_pointers(self):
+        index = self._target_index
+        pointers = self.pointer_table
+        for p in self._stale_pointers:
+            index.remove(p)
+            if p in pointers:
+                self.seek_pointer(p)
+                index.add(p, self.read_int())
+        self._stale_pointers = set()
+
     @preserve_pos
+    def pointer_targets(self):
+        """
+        Returns a list of (pointer offset, target offset) for every entry in
+        the relocation table, as data section offsets.
+        """
+        self.seek(self.header_size)
+        data = self.read(self.data_size)
+        return [(p, Int.unpack_from(data, p)[0]) for p in self.pointer_table]
+
     def next_target(self, location):
         """Returns the next offset greater than `location` that is the target
         of a pointer. Returns a raw file offset, not a data section offset."""
-        found = None
+        targets = self.target_index.targets
+        i = bisect_right(targets, location - self.header_size)
+        return self.pointer(targets[i]) if i < len(targets) else None
+
+    def referrers(self, location):
+        """Returns the raw file offsets of every pointer that points at raw
+        file offset `location`."""
+        found = self.target_index.referrers.get(location - self.header_size, ())
+        return [self.pointer(p) for p in found]
+
+    def block_size(self, location):
+        """Size of the block starting at raw file offset `location`, taken to
+        end at the next pointer target or at the end of the data section."""
+        end = self.next_target(location)
+        if end is None:
+            end = self.header_size + self.data_size
+        return end - location
+
+    def known_extents(self):
+        """
+        Returns a dict of start -> end raw file offset for blocks whose size
+        is known exactly. find_free_space takes any other block to run up to
+        the next target of a pointer it reached.
+        """
+        return {}
+
+    @preserve_pos
+    def find_free_space(self):
+        """
+        Work out which bytes of the data section nothing uses: everything
+        that can't be reached by following pointers from the root and
+        reference nodes, plus whatever free_space already had. free_space is
+        replaced with the result, which is also returned.
+        """
+        hs = self.header_size
+        data_end = hs + self.data_size
+        pointers = dict(self.pointer_targets())
+        locations = sorted(pointers)
+        extents = self.known_extents()
+        # blocks only end at known extents or where something reached points,
+        # so pointers nothing uses can't cut a live block short. Each pass
+        # walks every block reached so far, until one finds no new targets.
+        reached = []
+        used = []
+        new = {self.pointer(node.pointer)
+               for table in (self.root_nodes, self.ref_nodes)
+               for node in table
+               if hs <= self.pointer(node.pointer) < data_end}
+        while new:
+            for start in new:
+                insort(reached, start)
+            seen = set(reached)
+            new = set()
+            used = []
+            for k, start in enumerate(reached):
+                end = (extents.get(start)
+                       or (reached[k+1] if k + 1 < len(reached) else data_end))
+                used.append((start, end))
+                i = bisect_left(locations, start - hs)
+                j = bisect_left(locations, end - hs)
+                new.update(self.pointer(pointers[p]) for p in locations[i:j])
+            new = {start for start in new
+                   if hs <= start < data_end and start not in seen}
+        free = FreeSpaceMap()
+        position = hs
+        for start, end in sorted(used):
+            free.add(position, start)
+            position = max(position, end)
+        free.add(position, data_end)
+        for start, end in self.free_space:
+            free.add(start, end)
+        self.free_space = free
+        return free
+
+    @preserve_pos
+    def compact(self):
+        """
+        Rewrite the file without the bytes find_free_space finds unused, in
+        one pass: the data that's kept is written out contiguously (with
+        fresh padding in front of aligned blocks), followed by a new
+        relocation table, the root and reference nodes, and the string table.
+        Returns the number of bytes the data section shrank by.
+        """
+        hs = self.header_size
+        old_data_end = hs + self.data_size
+        free = self.find_free_space()
+        aligned = dict(self.aligned_offsets)
+        pieces = []
+        position = hs
+        for start, end in list(free) + [(old_data_end, old_data_end)]:
+            cuts = [offset for offset in aligned if position < offset < start]
+            for cut in sorted(cuts):
+                pieces.append((position, cut))
+                position = cut
+            if start > position:
+                pieces.append((position, start))
+            position = end
+        self.seek(0)
+        old = self.read()
+        padding = Int.pack(ALIGN_PADDING)
+        data = bytearray()
+        segments = []  # (old start, old end, new start)
+        for start, end in pieces:
+            if end in aligned:
+                # the old padding is replaced below
+                while end - 4 >= start and old[end-4:end] == padding:
+                    end -= 4
+            alignment = aligned.get(start)
+            if alignment:
+                amount = -(hs + len(data)) % alignment
+                data += bytes(amount % 4) + padding*(amount//4)
+            segments.append((start, end, hs + len(data)))
+            data += old[start:end]
+        data += bytes(-len(data) % 4)
+        starts = [start for start, end, new_start in segments]
+
+        def relocate(offset):
+            i = bisect_right(starts, offset) - 1
+            if i < 0 or offset >= old_data_end:
+                return offset
+            start, end, new_start = segments[i]
+            return new_start + min(offset, end) - start
+
+        def kept(offset, size=0):
+            i = bisect_right(starts, offset) - 1
+            return i >= 0 and offset + size <= segments[i][1]
+
+        pointer_table = []
         for p in self.pointer_table:
-            self.seek(self.pointer(p))
-            val = self.pointer(self.read_int())
-            if val > location and (found is None or val < found):
-                found = val
-        return found
+            location = self.pointer(p)
+            if not kept(location, 4):
+                continue
+            new_p = relocate(location) - hs
+            value = Int.unpack_from(old, location)[0]
+            Int.pack_into(data, new_p, relocate(self.pointer(value)) - hs)
+            pointer_table.append(new_p)
+        pointer_table.sort()
+        nodes = b''.join(
+                table.struct.pack(relocate(self.pointer(node.pointer)) - hs,
+                                  node.str_pointer)
+                for table in (self.root_nodes, self.ref_nodes)
+                for node in table)
+        header = Header.pack(hs + len(data) + 4*len(pointer_table)
+                             + len(old) - self.root_nodes.start_offset,
+                             len(data), len(pointer_table),
+                             self.root_node_count, self.ref_node_count)
+        splice(self.f, 0, len(old),
+               header + old[Header.size:hs] + data
+               + struct.pack(f'>{len(pointer_table)}I', *pointer_table)
+               + nodes + old[self.ref_nodes.end_offset:])
+        # every pointer has moved, so the index is built again when needed
+        self._target_index = None
+        self.data_changed(0)
+        self._aligned_offsets = [(relocate(offset), alignment)
+                                 for offset, alignment in self.aligned_offsets
+                                 if kept(offset)]
+        self._remap_offsets(relocate)
+        return old_data_end - hs - len(data)
+
+    def to_graph(self):
+        """Returns a datgraph.DatGraph of the file as it is now, to make
+        edits in and then put back with apply_graph"""
+        import datgraph  # which imports this module
+        return datgraph.DatGraph.from_file(self)
+
+    def apply_graph(self, graph):
+        """
+        Replace the contents of the file with `graph` (from to_graph) written
+        out, in one splice. Tables that were in the file are moved to where
+        their bytes are in the graph's layout.
+        """
+        hs = self.header_size
+        old_data_end = hs + self.data_size
+        moved = graph.relocation()
+
+        def relocate(offset):
+            if hs <= offset < old_data_end:
+                return hs + moved(offset - hs)
+            return offset
+
+        aligned = [(hs + offset, block.alignment)
+                   for block, offset in graph.layout().items()
+                   if block.alignment]
+        splice(self.f, 0, self.file_size, graph.serialize())
+        self._target_index = None
+        self.data_changed(0)
+        self._aligned_offsets = sorted(aligned)
+        self._remap_offsets(relocate)
+        self.root_nodes.length = self.root_node_count
+        self.ref_nodes.start_offset = self.root_nodes.end_offset
+        self.ref_nodes.length = self.ref_node_count
+
+    def _remap_offsets(self, relocate):
+        """Bring everything that holds offsets up to date after compact,
+        which moved old offset `x` to relocate(x)"""
+        self.remap_table_offsets(relocate)
+        self.remove_inplace_table(self.pointer_table)
+        self.pointer_table = self.inplace_int_table(
+                self.header_size + self.data_size, self.n_pointers)
+        self.root_nodes.start_offset = self.pointer_table.end_offset
+        self.ref_nodes.start_offset = self.root_nodes.end_offset
+        self.free_space = FreeSpaceMap()
 
     @preserve_pos
     def insert(self, location, amount=None, data=None):
@@ -159,26 +577,89 @@ class BaseDatFile (HasInPlaceTables):
             amount = len(data)
         if amount == 0:
             return
-        self.adjust_pointers(location, amount)
-
-        self.seek(0)
-        before = self.read(location)
+        # aligned offsets have to be found before anything moves
+        self.aligned_offsets
+        self.data_changed(location)
         if amount < 0:
-            self.seek(-amount, SEEK_CUR)
-        after = self.read()
-        data = before + data + after
-        self.seek(0)
-        self.truncate()
-        self.write(data)
+            splice(self.f, location, -amount)
+        else:
+            splice(self.f, location, 0, data)
         self.file_size += amount
         self.update_table_offsets(location, amount)
-        if location <= self.data_size + self.header_size:
+        self.free_space.shift(location, amount)
+        if location == self.data_size + self.header_size:
+            # appended to the data section, which doesn't move anything that
+            # can be pointed at
             self.data_size += amount
+        elif location < self.data_size + self.header_size:
+            self.data_size += amount
+            # nothing points past the data section, so inserts into the
+            # relocation table or node tables don't need any relocation
+            if self._pending_shifts is not None:
+                self._pending_shifts.add(location, amount)
+            else:
+                self.adjust_pointers(location, amount)
         self.update_aligned_offsets(location, amount)
 
+    @property
+    def aligned_offsets(self):
+        """
+        Sorted list of (offset, alignment) for blocks that have to stay
+        aligned when data is inserted before them. Filled in by
+        find_aligned_offsets the first time it is needed.
+        """
+        if self._aligned_offsets is None:
+            self._aligned_offsets = []
+            self.find_aligned_offsets()
+        return self._aligned_offsets
+
+    def find_aligned_offsets(self):
+        """Call set_offset_aligned for everything that needs alignment.
+        Nothing does in a generic dat file."""
+        pass
+
     def set_offset_aligned(self, offset, alignment):
-        self.aligned_offsets.append((offset, alignment))
-        self.aligned_offsets.sort(key=lambda entry: entry[0])
+        insort(self.aligned_offsets, (offset, alignment))
+
+    def walk_model(self, jobjdesc_offset, debug_print=False):
+        """
+        Find every JObj, DObj, MObj, TObj, image header and image in the model
+        whose root JObj is at raw file offset `jobjdesc_offset`. Returns a
+        ModelNodes of lists of raw file offsets, in the order they were found.
+        Each node is read once, even if several others point to it.
+        """
+        found = ModelNodes([jobjdesc_offset], [], [], [], [], [])
+        seen = {('jobj', jobjdesc_offset)}
+
+        def add(nodes, kind, pointer):
+            if pointer:
+                offset = self.pointer(pointer)
+                if (kind, offset) not in seen:
+                    seen.add((kind, offset))
+                    nodes.append(offset)
+                    if debug_print: print(kind, 'at', hex(offset))
+
+        # each list grows as it is walked, so this is breadth-first
+        for offset in found.jobjs:
+            jobj = self.read_struct(offset, JObjDesc)
+            add(found.jobjs, 'jobj', jobj.next_sibling_pointer)
+            add(found.jobjs, 'jobj', jobj.child_pointer)
+            add(found.dobjs, 'dobj', jobj.dobj_pointer)
+        for offset in found.dobjs:
+            dobj = self.read_struct(offset, DObjDesc)
+            add(found.dobjs, 'dobj', dobj.next_sibling_pointer)
+            add(found.mobjs, 'mobj', dobj.mobj_pointer)
+        for offset in found.mobjs:
+            mobj = self.read_struct(offset, MObjDesc)
+            add(found.tobjs, 'tobj', mobj.tobj_pointer)
+        for offset in found.tobjs:
+            tobj = self.read_struct(offset, TObjDesc)
+            add(found.tobjs, 'tobj', tobj.next_sibling_pointer)
+            add(found.image_headers, 'image header', tobj.image_header_pointer)
+        for offset in found.image_headers:
+            image_header = self.read_struct(offset, ImageHeader)
+            add(found.images, 'image data', image_header.image_data_pointer)
+        return found
 
     def update_aligned_offsets(self, location, amount):
 #        print([(hex(a), hex(b)) for a, b in self.aligned_offsets])
@@ -227,9 +708,18 @@ class BaseDatFile (HasInPlaceTables):
 
     @preserve_pos
     def save(self, fname):
+        if hasattr(self.f, 'save'):
+            # in-memory and memory mapped storage know how to save
+            # themselves, only writing what changed where possible
+            self.f.save(fname)
+            return
+        self.f.flush()
+        if os.path.exists(fname) and os.path.samefile(fname, self.f.name):
+            return  # edits were written straight to the file
         self.seek(0)
+        data = self.read()
         with open(fname, 'wb') as f:
-            f.write(self.read())
+            f.write(data)
 
     def read_string(self, strip_terminator=False):
         s = b''
@@ -253,6 +743,248 @@ class BaseDatFile (HasInPlaceTables):
         return self.read_string(strip_terminator=True)
 
 
+class FreeSpaceMap:
+    """
+    Ranges of bytes in the data section that nothing uses any more, as a
+    sorted list of non-overlapping (start, end) raw file offsets. Kept up to
+    date with inserts and deletes by BaseDatFile.insert.
+    """
+    def __init__(self):
+        self.ranges = []
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    @property
+    def total(self):
+        """Total number of free bytes"""
+        return sum(end - start for start, end in self.ranges)
+
+    def add(self, start, end):
+        """Mark bytes `start` to `end` as free"""
+        if end <= start:
+            return
+        i = bisect_left(self.ranges, (start, end))
+        # merge with any ranges it touches or overlaps
+        while i > 0 and self.ranges[i-1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(self.ranges) and self.ranges[j][0] <= end:
+            start = min(start, self.ranges[j][0])
+            end = max(end, self.ranges[j][1])
+            j += 1
+        self.ranges[i:j] = [(start, end)]
+
+    def remove(self, start, end):
+        """Mark bytes `start` to `end` as used"""
+        kept = []
+        for free_start, free_end in self.ranges:
+            if free_end <= start or free_start >= end:
+                kept.append((free_start, free_end))
+                continue
+            if free_start < start:
+                kept.append((free_start, start))
+            if free_end > end:
+                kept.append((end, free_end))
+        self.ranges = kept
+
+    def allocate(self, size):
+        """
+        Returns the start of the smallest free range that can hold `size`
+        bytes and marks those bytes as used, or returns None if none of them
+        are big enough.
+        """
+        fits = [(end - start, start) for start, end in self.ranges
+                if end - start >= size]
+        if not fits:
+            return None
+        _, start = min(fits)
+        self.remove(start, start + size)
+        return start
+
+    def shift(self, location, amount):
+        """Update for `amount` bytes inserted at `location`, or deleted if
+        `amount` is negative"""
+        shifted = []
+        for start, end in self.ranges:
+            if amount < 0:
+                # bytes location to location-amount are gone
+                deleted_end = location - amount
+                start = (start if start < location else
+                         location if start < deleted_end else start + amount)
+                end = (end if end < location else
+                       location if end < deleted_end else end + amount)
+                if end > start:
+                    shifted.append((start, end))
+            elif end <= location:
+                shifted.append((start, end))
+            elif start >= location:
+                shifted.append((start + amount, end + amount))
+            else:  # inserted into the middle, which uses the new bytes
+                shifted.extend([(start, location),
+                                (location + amount, end + amount)])
+        self.ranges = shifted
+
+
+class _TargetIndex:
+    """
+    Reverse lookup for the relocation table: the sorted list of every offset
+    that is pointed to, and a map from each of those to the offsets of the
+    pointers that point at it. All offsets are data section offsets.
+    """
+    def __init__(self, pointer_targets):
+        self.pointers = dict(pointer_targets)  # pointer -> target
+        self._build()
+
+    def _build(self):
+        self.referrers = defaultdict(list)
+        for p, target in self.pointers.items():
+            self.referrers[target].append(p)
+        self.referrers = dict(self.referrers)
+        self.targets = sorted(self.referrers)
+
+    def add(self, p, target):
+        self.remove(p)
+        self.pointers[p] = target
+        if target in self.referrers:
+            self.referrers[target].append(p)
+        else:
+            self.referrers[target] = [p]
+            insort(self.targets, target)
+
+    def remove(self, p):
+        target = self.pointers.pop(p, None)
+        if target is None:
+            return
+        found = self.referrers[target]
+        found.remove(p)
+        if not found:
+            del self.referrers[target]
+            del self.targets[bisect_left(self.targets, target)]
+
+    def shift(self, move, is_deleted):
+        """
+        Move every pointer and target with the function `move`, the way
+        relocate_pointers does. Pointers whose own bytes were deleted aren't
+        rewritten by relocate_pointers, so they are dropped; returns where
+        they are now.
+        """
+        deleted = [move(p) for p in self.pointers if is_deleted(p)]
+        self.pointers = {move(p): move(target)
+                         for p, target in self.pointers.items()
+                         if not is_deleted(p)}
+        self._build()
+        return deleted
+
+
+class _ScriptCache:
+    """
+    Decoded scripts, by start offset and script type, along with the offset
+    each one ends at so that a change to the file only throws out the
+    scripts it overlaps.
+    """
+    def __init__(self):
+        self.starts = []  # sorted
+        self.scripts = {}  # start offset -> {script type: (decoded, end)}
+        self.longest = 0
+
+    def get(self, start_offset, script_type):
+        entry = self.scripts.get(start_offset, {}).get(script_type)
+        return None if entry is None else entry[0]
+
+    def add(self, start_offset, script_type, decoded):
+        if not decoded:  # ran straight into the end of the file
+            return
+        ev, offset = decoded[-1]
+        end = offset + ev.length
+        if start_offset not in self.scripts:
+            insort(self.starts, start_offset)
+            self.scripts[start_offset] = {}
+        self.scripts[start_offset][script_type] = (decoded, end)
+        self.longest = max(self.longest, end - start_offset)
+
+    def forget(self, start, end=None):
+        """Drop scripts overlapping bytes `start` to `end`, or everything
+        from `start` on if `end` is None"""
+        # only scripts starting less than self.longest before `start` can
+        # reach it
+        i = bisect_right(self.starts, start - self.longest)
+        j = len(self.starts) if end is None else bisect_left(self.starts, end)
+        if i >= j:
+            return
+        for script_start in self.starts[i:j]:
+            by_type = self.scripts[script_start]
+            for script_type, (decoded, script_end) in list(by_type.items()):
+                if script_end > start:
+                    del by_type[script_type]
+            if not by_type:
+                del self.scripts[script_start]
+        self.starts[i:j] = [s for s in self.starts[i:j] if s in self.scripts]
+
+
+class _CallGraph:
+    """
+    Which scripts call or goto which. Every offset is the raw file offset of
+    the start of a script.
+
+    `roots` are the scripts the search started from, `callees` maps each
+    script found to the list of scripts it jumps to, `callers` maps each
+    script to the set of scripts that jump to it and `ends` maps each script
+    found to the offset it ends at.
+    """
+    def __init__(self, roots):
+        self.roots = roots
+        self.callees = {}
+        self.callers = defaultdict(set)
+        self.ends = {}
+        self.generation = None
+
+    def set_callees(self, offset, targets, end):
+        self.remove(offset)
+        self.callees[offset] = targets
+        self.ends[offset] = end
+        for target in targets:
+            self.callers[target].add(offset)
+
+    def remove(self, offset):
+        for target in self.callees.pop(offset, ()):
+            self.callers[target].discard(offset)
+        self.ends.pop(offset, None)
+
+    def shift(self, shift_map):
+        """Move every offset with `shift_map` (a ShiftMap). Returns False,
+        leaving the graph as it was, if any script start was deleted."""
+        offsets = self.callers.keys() | self.callees.keys()
+        if any(shift_map.is_deleted(offset) for offset in offsets):
+            return False
+        self.roots = [shift_map(offset) for offset in self.roots]
+        self.callees = {shift_map(offset): [shift_map(t) for t in targets]
+                        for offset, targets in self.callees.items()}
+        self.callers = defaultdict(set, {
+                shift_map(offset): {shift_map(c) for c in callers}
+                for offset, callers in self.callers.items()})
+        self.ends = {shift_map(offset): shift_map(end)
+                     for offset, end in self.ends.items()}
+        return True
+
+    def prune(self):
+        """Drop scripts that can't be reached from the roots any more"""
+        reachable = set()
+        stack = list(self.roots)
+        while stack:
+            offset = stack.pop()
+            if offset not in reachable:
+                reachable.add(offset)
+                stack.extend(self.callees.get(offset, ()))
+        for offset in [o for o in self.callees if o not in reachable]:
+            self.remove(offset)
+        for offset in [o for o, c in self.callers.items() if not c]:
+            del self.callers[offset]
+
+
 class MovesetDatFile (BaseDatFile):
 
     dat_kind = 'default'  # will be used to differentiate DatEx files
@@ -283,6 +1015,8 @@ class MovesetDatFile (BaseDatFile):
                                 ])
 
     def __init__(self, fname, mode='r+b', copy=True):
+        self._script_cache = _ScriptCache()
+        self._call_graph = None
         super().__init__(fname, mode, copy)
         self.index = self.inplace_table(
                 self.pointer(self.root_nodes[0].pointer),
@@ -321,27 +1055,41 @@ class MovesetDatFile (BaseDatFile):
                 names=names
                 )
 
-        self.hurtbox_header = self.inplace_struct(
+        self.seek(0)
+
+    # The rest of the tables are only set up when first used, so opening a
+    # file to edit a few scripts doesn't have to walk through all of it
+
+    @lazy_property
+    def hurtbox_header(self):
+        return self.inplace_struct(
                 self.pointer(self.index[12]),
                 NamedStruct('>II', 'HurtboxHeader',
                             ['n_hurtboxes', 'hurtbox_table_pointer']
                             )
                 )
 
-        self.hurtbox_table = self.inplace_table(
+    @lazy_property
+    def hurtbox_table(self):
+        return self.inplace_table(
                 self.pointer(self.hurtbox_header.hurtbox_table_pointer),
                 self.hurtbox_header.n_hurtboxes,
                 self.Hurtbox
                 )
 
-        self.ledge_grab_data = self.inplace_struct(
+    @lazy_property
+    def ledge_grab_data(self):
+        return self.inplace_struct(
                 self.pointer(self.index[17]),
                 struct.Struct('>IIIIfff'),
                 names=['Unknown', 'Unknown', 'Unknown', 'Unknown',
                        'Horizontal Scale', 'Vertical Offset', 'Vertical Scale']
                 )
 
-        self.articles = []
+    @lazy_property
+    @preserve_pos
+    def articles(self):
+        articles = []
         article_list_start = self.index[18]
         print('creating articles')
         if article_list_start:
@@ -353,82 +1101,22 @@ class MovesetDatFile (BaseDatFile):
                     self.seek(self.pointer(article_list_start))
                     self.seek(4*i, SEEK_CUR)
                     article_offset = self.pointer(self.read_int())
-                    self.articles.append(self.Article(self, article_offset, article_info, name))
+                    articles.append(self.Article(self, article_offset, article_info, name))
+        return articles
 
+    def find_aligned_offsets(self):
+        for article in self.articles:
+            for offset in article.image_offsets:
+                self.set_offset_aligned(offset, 32)
         self.jobjdesc_set_textures_aligned(self.pointer(self.index[23]))
 
-        self.seek(0)
-
     def jobjdesc_set_textures_aligned(self, jobjdesc_offset, debug_print=False):
         """
         Walk JObj to find tetures and set them as 32-byte aligned.
-        Not saving hierarchy info about any of these, need to write
-        a more in depth object oriented system for JObj, DObj, etc
-        """
-        root_jobj = self.inplace_struct(jobjdesc_offset, JObjDesc)
-        jobj_list = [root_jobj]
-        dobj_list = []
-        mobj_list = []
-        tobj_list = []
-        imageheader_list = []
-        image_offsets = []
-        for jobj in jobj_list:
-            # This adds to the list as it goes, processing in FIFO order
-            if jobj.next_sibling_pointer:
-                offset = self.pointer(jobj.next_sibling_pointer)
-                if not any(j.start_offset == offset for j in jobj_list): # don't add a duplicate
-                    jobj_list.append(self.inplace_struct(offset, JObjDesc))
-                    if debug_print:
-                        if debug_print: print('jobj at', hex(offset))
-            if jobj.child_pointer:
-                offset = self.pointer(jobj.child_pointer)
-                if not any(j.start_offset == offset for j in jobj_list):
-                    jobj_list.append(self.inplace_struct(offset, JObjDesc))
-                    if debug_print:
-                        if debug_print: print('jobj at', hex(offset))
-            if jobj.dobj_pointer:
-                offset = self.pointer(jobj.dobj_pointer)
-                if not any(d.start_offset == offset for d in dobj_list):
-                    dobj_list.append(self.inplace_struct(offset, DObjDesc))
-                    if debug_print: print('dobj at', hex(offset))
-        for dobj in dobj_list:
-            if dobj.next_sibling_pointer:
-                offset = self.pointer(dobj.next_sibling_pointer)
-                if not any(d.start_offset == offset for d in dobj_list):
-                    dobj_list.append(self.inplace_struct(offset, DObjDesc))
-                    if debug_print: print('dobj at', hex(offset))
-            if dobj.mobj_pointer:
-                offset = self.pointer(dobj.mobj_pointer)
-                if not any(m.start_offset == offset for m in mobj_list):
-                    mobj_list.append(self.inplace_struct(offset, MObjDesc))
-                    if debug_print: print('mobj at', hex(offset))
-        for mobj in mobj_list:
-            if mobj.tobj_pointer:
-                offset = self.pointer(mobj.tobj_pointer)
-                if not any(t.start_offset == offset for t in tobj_list):
-                    tobj_list.append(self.inplace_struct(offset, TObjDesc))
-                    if debug_print: print('tobj at', hex(offset))
-        for tobj in tobj_list:
-            if tobj.next_sibling_pointer:
-                offset = self.pointer(tobj.next_sibling_pointer)
-                if not any(t.start_offset == offset for t in tobj_list):
-                    tobj_list.append(self.inplace_struct(offset, TObjDesc))
-                    if debug_print: print('tobj at', hex(offset))
-            if tobj.image_header_pointer:
-                offset = self.pointer(tobj.image_header_pointer)
-                if not any(h.start_offset == offset for h in imageheader_list):
-                    imageheader_list.append(self.inplace_struct(offset, ImageHeader))
-                    if debug_print: print('image header at', hex(offset))
-        for ih in imageheader_list:
-            if ih.image_data_pointer:
-                offset = self.pointer(ih.image_data_pointer)
-                if offset not in image_offsets:
-                    image_offsets.append(offset)
-                    if debug_print: print('image data at', hex(offset))
-                    self.set_offset_aligned(offset, 32)
-        # cleanup
-        for item in jobj_list+dobj_list+mobj_list+tobj_list+imageheader_list:
-            self.remove_inplace_table(item)
+        """
+        image_offsets = self.walk_model(jobjdesc_offset, debug_print).images
+        for offset in image_offsets:
+            self.set_offset_aligned(offset, 32)
         return image_offsets
 
     class Article ():
@@ -495,10 +1183,10 @@ class MovesetDatFile (BaseDatFile):
             print(hex(self.data.jobj_pointer_pointer))
             self.f.seek(self.f.pointer(self.data.jobj_pointer_pointer))
             root_jobj_pointer = self.f.read_int()
-            self.image_offsets = []
+            self.root_jobj_offset = None
             if self.f.is_valid_pointer(root_jobj_pointer):
                 print('root jobj at', hex(root_jobj_pointer))
-                self.image_offsets = self.f.jobjdesc_set_textures_aligned(self.f.pointer(root_jobj_pointer))
+                self.root_jobj_offset = self.f.pointer(root_jobj_pointer)
             else:
                 print('no root jobj, value was {:x}'.format(root_jobj_pointer))
 
@@ -522,6 +1210,21 @@ class MovesetDatFile (BaseDatFile):
                 self.hurtbox_table = None
 
 
+        def tables(self):
+            """The in-place tables the article reads from"""
+            return [table for table in (self.data, self.header,
+                                        self.attributes, *self.variants,
+                                        self.hurtbox_header,
+                                        self.hurtbox_table)
+                    if table is not None]
+
+        @lazy_property
+        def image_offsets(self):
+            """Offsets of the texture image data in the article's model"""
+            if self.root_jobj_offset is None:
+                return []
+            return self.f.walk_model(self.root_jobj_offset).images
+
         def script(self, variant_number):
             script_offset_raw = self.variants[variant_number].script_pointer
             if not script_offset_raw:
@@ -577,69 +1280,432 @@ class MovesetDatFile (BaseDatFile):
             except ValueError:
                 pass
 
+    @preserve_pos
+    def extract_event_fields(self, code, custom_code=None):
+        """
+        Returns a numpy structured array of the fields of every event of the
+        given type in the subaction scripts, with the subaction number and
+        offset of each one. See script.extract_fields.
+        """
+        scripts = [(i, self.pointer(subaction.script_pointer))
+                   for i, subaction in self.iter_subactions()]
+        if hasattr(self.f, 'getbuffer'):
+            with self.f.getbuffer() as view:
+                return script.extract_fields(view, scripts, code, custom_code)
+        self.seek(0)
+        return script.extract_fields(self.read(), scripts, code, custom_code)
+
     def script_at(self, start_offset, script_type=script.FIGHTER):
-        self.seek(start_offset)
-        return script.read_script(self, include_terminator=True, script_type=script_type)
+        """
+        Returns the list of events in the script at `start_offset`, including
+        the terminator, and leaves the file position at the end of it.
+        """
+        decoded = self.decode_script_at(start_offset, script_type)
+        if decoded:
+            ev, offset = decoded[-1]
+            self.seek(offset + ev.length)
+        else:
+            self.seek(start_offset)
+        return [ev for ev, offset in decoded]
 
-    def replace_subaction_script(self, subaction_number, new_script):
+    def decode_script_at(self, start_offset, script_type=script.FIGHTER):
+        """
+        Returns a list of (event, offset) pairs for the script at
+        `start_offset`, including the terminator. Scripts are only decoded
+        again after the bytes they were decoded from change, and the events
+        returned are copies, so they can be edited freely.
+        """
+        return [(ev.copy(), offset) for ev, offset
+                in self._decoded_script(start_offset, script_type)]
+
+    def _decoded_script(self, start_offset, script_type=script.FIGHTER):
+        """Same as decode_script_at, but returns the cached events
+        themselves. Don't modify them."""
+        decoded = self._script_cache.get(start_offset, script_type)
+        if decoded is not None:
+            return decoded
+        if hasattr(self.f, 'getbuffer'):
+            with self.f.getbuffer() as view:
+                decoded = script.decode_script(view, start_offset,
+                                               include_terminator=True,
+                                               script_type=script_type)
+        else:
+            self.seek(start_offset)
+            decoded = list(script.iter_script(
+                    script.read_script(self, include_terminator=True,
+                                       script_type=script_type),
+                    start_offset))
+        self._script_cache.add(start_offset, script_type, decoded)
+        return decoded
+
+    def data_changed(self, start, end=None):
+        super().data_changed(start, end)
+        self._script_cache.forget(start, end)
+
+    def replace_subaction_script(self, subaction_number, new_script,
+                                 relocate=False):
         start_offset = self.pointer(
                 self.get_subaction(subaction_number).script_pointer)
-        self.replace_script_at(start_offset, new_script)
+        if relocate:
+            self.relocate_script(start_offset, new_script)
+        else:
+            self.replace_script_at(start_offset, new_script)
 
-    def replace_script_at(self, start_offset, new_script):
+    def relocate_script(self, start_offset, new_script):
+        """
+        Replace the script at `start_offset` with `new_script` without moving
+        anything else in the file, unlike replace_script_at.
+
+        A script that still fits is written over the old one. One that doesn't
+        goes in the smallest range in free_space it fits in, or else on the
+        end of the data section, and everything that pointed at the old script
+        is pointed at the new one. Whatever is left of the old script is added
+        to free_space, unless something else still points into it or runs
+        into it.
+
+        Pointers in `new_script` are written as they are; ones to the old
+        script itself are pointed at the new one. Returns where the script is
+        now.
+        """
+        hs = self.header_size
         old_script = self.script_at(start_offset)
         end_offset = self.tell()
-        insert_length = script.script_length(new_script) - script.script_length(old_script)
-        if insert_length < 0:
-                manual_pointer_delta = insert_length
-                for _ in range((-insert_length)//4):
-                    self.insert(start_offset+4, amount=-4)
+        new_length = script.script_length(new_script)
+        index = self.target_index
+        referrers = [self.pointer(p) for p
+                     in index.referrers.get(start_offset - hs, ())]
+        if new_length <= end_offset - start_offset:
+            new_start = start_offset
+            unused_start = start_offset + new_length
         else:
-            manual_pointer_delta = 0
-            self.insert(end_offset, insert_length)
-        self.seek(start_offset)
-        for ev in new_script:
-            self.write(bytes(ev))
-        # update pointer table for any subaction calls or gotos
+            new_start = self.free_space.allocate(new_length)
+            if new_start is None:
+                new_start = self.header_size + self.data_size
+                self.insert(new_start, new_length)
+            unused_start = start_offset
+        # the old bytes can only go if nothing else jumps into them, and no
+        # other script runs on into them. Pointers to the start of a script
+        # that moves are pointed at the new one below.
+        i = bisect_left(index.targets, unused_start - hs)
+        if (new_start != start_offset and i < len(index.targets)
+                and index.targets[i] == start_offset - hs):
+            i += 1
+        unused = not (i < len(index.targets)
+                      and index.targets[i] < end_offset - hs)
+        if unused and end_offset > unused_start:
+            unused = not any(start < unused_start < end
+                             for start, end in self.script_extents().items()
+                             if start != start_offset)
+        # drop the old pointers from whatever is overwritten or freed
         for p in script.pointer_offsets(old_script, start_offset):
-            self.delete_pointer(p + manual_pointer_delta - self.header_size)
-        for p in script.pointer_offsets(new_script, start_offset):
+            if p < unused_start or unused:
+                self.delete_pointer(p - hs)
+        if unused:
+            self.free_space.add(unused_start, end_offset)
+        data = bytearray(b''.join(bytes(ev) for ev in new_script))
+        new_pointers = script.pointer_offsets(new_script, new_start)
+        for p in new_pointers:
+            if Int.unpack_from(data, p - new_start)[0] == start_offset - hs:
+                Int.pack_into(data, p - new_start, new_start - hs)
+        self.seek(new_start)
+        self.write(data)
+        for p in new_pointers:
+            self.add_pointer(p - hs)
+        if new_start != start_offset:
+            for p in referrers:
+                self.seek(p)
+                self.write(Int.pack(new_start - hs))
+        return new_start
+
+    def replace_script_at(self, start_offset, new_script):
+        """
+        Replace the script at `start_offset` with the list of events
+        `new_script`, resizing it with a single insert or delete in the part
+        where the old and new events differ, so that pointers to events after
+        that part move along with them.
+
+        Pointers in `new_script` should point to where things are before the
+        replacement; they are relocated along with the rest of the file.
+        Returns the ShiftMap of the resize. Can't be used inside a
+        transaction, since it reads and writes pointers.
+        """
+        if self._pending_shifts is not None:
+            raise RuntimeError("replace_script_at can't be used inside a "
+                               "transaction")
+        call_graph = self._call_graph
+        if call_graph is not None and (call_graph.generation
+                                       != self.edit_generation):
+            call_graph = None
+        old_script = self.script_at(start_offset)
+        end_offset = self.tell()
+        new_length = script.script_length(new_script)
+        insert_length = new_length - (end_offset - start_offset)
+        old_bytes = [bytes(ev) for ev in old_script]
+        new_bytes = [bytes(ev) for ev in new_script]
+        same = 0
+        for old_ev, new_ev in zip(old_bytes, new_bytes):
+            if old_ev != new_ev:
+                break
+            same += 1
+        tail = 0
+        for old_ev, new_ev in zip(reversed(old_bytes[same:]),
+                                  reversed(new_bytes[same:])):
+            if old_ev != new_ev:
+                break
+            tail += 1
+        # the bytes go in or come out where the events that differ end in the
+        # shorter of the two scripts, just before the events they both end in
+        while True:
+            tail_length = sum(map(len, new_bytes[len(new_bytes)-tail:]))
+            changed_end = (start_offset - tail_length
+                           + min(new_length, end_offset - start_offset))
+            if changed_end > start_offset or not tail or not insert_length:
+                break
+            # not right at the start, which would move or delete the target
+            # of pointers to the script itself
+            tail -= 1
+        # take the old script's pointers out of the relocation table first,
+        # so nothing tries to relocate them once their bytes are gone
+        for p in script.pointer_offsets(old_script, start_offset):
+            self.delete_pointer(p - self.header_size)
+        with self.transaction():
+            self.insert(changed_end, amount=insert_length)
+            shift_map = self._pending_shifts
+        data = bytearray(b''.join(bytes(ev) for ev in new_script))
+        new_pointers = script.pointer_offsets(new_script, start_offset)
+        if shift_map:
+            for p in new_pointers:
+                target = self.pointer(Int.unpack_from(data, p - start_offset)[0])
+                Int.pack_into(data, p - start_offset,
+                              shift_map(target) - self.header_size)
+        self.seek(start_offset)
+        self.write(data)
+        for p in new_pointers:
             self.add_pointer(p - self.header_size)
+        # the call graph can be updated instead of rebuilt
+        if call_graph is not None:
+            self._update_call_graph(call_graph, shift_map, start_offset)
+        return shift_map
+
+    def script_targets(self, script_offset):
+        """Offsets of the scripts jumped to by subroutine and goto events in
+        the script at `script_offset`"""
+        return self._script_targets(self._decoded_script(script_offset))
 
-    def find_subroutines(self, max_recursion_depth=5):
+    def _script_targets(self, decoded):
+        return [self.pointer(Int.unpack_from(bytes(ev), p)[0])
+                for ev, offset in decoded
+                for p in ev.pointers if p is not None]
+
+    @property
+    def call_graph(self):
+        """
+        _CallGraph of every script reachable from the subaction table through
+        subroutine and goto events. Built the first time it's needed, then
+        kept up to date by replace_script_at; any other edit makes it get
+        rebuilt on the next access.
+        """
+        graph = self._call_graph
+        if graph is None or graph.generation != self.edit_generation:
+            graph = _CallGraph(self._script_roots())
+            self._extend_call_graph(graph, graph.roots)
+            graph.generation = self.edit_generation
+            self._call_graph = graph
+        return graph
+
+    def _script_roots(self):
+        return [self.pointer(entry.script_pointer)
+                for entry in self.subaction_table]
+
+    def _add_to_call_graph(self, graph, offset):
+        """(Re)decode the script at `offset` into `graph` and return the
+        offsets it jumps to"""
+        decoded = self._decoded_script(offset)
+        targets = self._script_targets(decoded)
+        if decoded:
+            ev, end = decoded[-1]
+            end += ev.length
+        else:
+            end = offset
+        graph.set_callees(offset, targets, end)
+        return targets
+
+    def _extend_call_graph(self, graph, offsets):
+        """Add the scripts at `offsets` and everything they reach to `graph`,
+        skipping any it already has"""
+        queue = deque(offsets)
+        while queue:
+            offset = queue.popleft()
+            if offset not in graph.callees:
+                queue.extend(self._add_to_call_graph(graph, offset))
+
+    def _update_call_graph(self, graph, shift_map, script_offset):
+        """Bring `graph` up to date after the script at `script_offset` was
+        replaced, moving everything else by `shift_map`"""
+        if shift_map and not graph.shift(shift_map):
+            self._call_graph = None
+            return
+        graph.roots = self._script_roots()
+        targets = list(self._add_to_call_graph(graph, script_offset))
+        # other scripts can share bytes with this one, when something jumps
+        # into the middle of it or it runs on into the next one
+        script_end = graph.ends[script_offset]
+        for offset, end in list(graph.ends.items()):
+            overlaps = offset < script_end and end > script_offset
+            if overlaps and offset != script_offset:
+                targets += self._add_to_call_graph(graph, offset)
+        self._extend_call_graph(graph, targets + graph.roots)
+        graph.prune()
+        graph.generation = self.edit_generation
+        self._call_graph = graph
+
+    def find_subroutines(self, max_recursion_depth=None):
+        """
+        Finds subroutine and goto events and returns a sorted list of the
+        locations they jump to, following calls from those locations as
+        deep as they go.
+
+        `max_recursion_depth` is no longer used; every nested call is found.
+        """
+        return sorted(target for target, callers
+                      in self.call_graph.callers.items() if callers)
+
+    def script_extents(self):
+        """
+        Returns a dict of start offset -> end offset for the script of every
+        subaction (in both subaction tables) and every script they call or go
+        to.
         """
-        Finds subroutine and goto events and returns a list of the locations
-        they jump to.
+        extents = {}
+        queue = deque(self.pointer(subaction.script_pointer)
+                      for i, subaction in self.iter_subactions())
+        while queue:
+            offset = queue.popleft()
+            if offset in extents:
+                continue
+            decoded = self._decoded_script(offset)
+            if decoded:
+                ev, end = decoded[-1]
+                extents[offset] = end + ev.length
+            else:
+                extents[offset] = offset
+            queue.extend(self._script_targets(decoded))
+        return extents
+
+    def known_extents(self):
+        # anything after a script's end event is unused, unless something
+        # else points at it
+        return {start: end for start, end in self.script_extents().items()
+                if end > start}
+
+    def _remap_offsets(self, relocate):
+        super()._remap_offsets(relocate)
+        # articles hold plain offsets, so read them again when next needed
+        for article in self.__dict__.pop('articles', ()):
+            for table in article.tables():
+                self.remove_inplace_table(table)
+
+    def deduplicate_scripts(self, merge_tails=True):
+        """
+        Make the file smaller by only keeping one copy of scripts that are
+        identical byte for byte: whatever pointed to the other copies is
+        pointed at the first one instead, and the other copies are deleted.
+
+        With `merge_tails`, a script that ends the same way as another one
+        (by more than the length of a Go To event) has that ending replaced
+        with a Go To into the other script.
 
-        Recursively searches for nested calls, up to `max_recursion_depth`
-        layers deep.
+        Bytes are only deleted when nothing else points into them or runs
+        into them. All of the deletes are done in one transaction. Returns the
+        number of bytes the data section shrank by.
         """
-        def check_and_append(pointer_list):
-            changed = False
-            for p in pointer_list:
+        hs = self.header_size
+        old_size = self.data_size
+        extents = self.script_extents()
+        starts = sorted(extents)
+        referrers = {self.pointer(target): [self.pointer(p) for p in found]
+                     for target, found in self.target_index.referrers.items()}
+        contents = {start: self.peek_at(start, extents[start] - start)
+                    for start in starts}
+        originals = {}
+        repoint = {}  # duplicate start -> start of the copy being kept
+        for start in starts:
+            if contents[start]:
+                first = originals.setdefault(contents[start], start)
+                if first != start:
+                    repoint[start] = first
+        # what will still be pointed at once the duplicates aren't
+        targets = sorted(set(referrers) - set(repoint))
+
+        def can_free(owner, start, end):
+            """True if nothing but script `owner` uses bytes start to end. A
+            pointer to `start` itself is fine."""
+            i = bisect_right(targets, start)
+            if i < len(targets) and targets[i] < end:
+                return False
+            return not any(other != owner and other not in repoint
+                           and other < end and extents[other] > start
+                           for other in starts)
+
+        regions = [(start, extents[start]) for start in repoint
+                   if can_free(start, start, extents[start])]
+        gotos = []  # (offset, target)
+        if merge_tails:
+            goto_length = script.event(script.FIGHTER).blank(0x1C).length
+            tails = {}  # bytes -> offset of a kept script that ends with them
+            for start in starts:
+                if start in repoint or not contents[start]:
+                    continue
+                data = contents[start]
+                offsets = [offset - start for ev, offset
+                           in self._decoded_script(start)]
+                merged = False
+                for k in offsets[1:]:
+                    tail = data[k:]
+                    if (len(tail) > goto_length and tail in tails
+                            and can_free(start, start + k, extents[start])):
+                        gotos.append((start + k, tails[tail]))
+                        regions.append((start + k + goto_length,
+                                        extents[start]))
+                        merged = True
+                        break
+                if not merged:
+                    for k in offsets:
+                        tails.setdefault(data[k:], start + k)
+        if not regions:
+            return 0
+        # adjacent or overlapping regions are deleted together
+        regions.sort()
+        merged_regions = [regions[0]]
+        for start, end in regions[1:]:
+            if start <= merged_regions[-1][1]:
+                merged_regions[-1] = (merged_regions[-1][0],
+                                      max(end, merged_regions[-1][1]))
+            else:
+                merged_regions.append((start, end))
+        # everything gets repointed and rewritten before anything moves
+        for duplicate, original in repoint.items():
+            for p in referrers.get(duplicate, ()):
                 self.seek(p)
-                offset = self.pointer(Int.unpack(self.read(4))[0])
-                if offset not in subroutine_locations:
-                    subroutine_locations.append(offset)
-                    changed = True
-            return changed
-
-        subroutine_locations = []
-        for i, entry in enumerate(self.subaction_table):
-            pointer_list = script.pointer_offsets(
-                    self.subaction_script(i),
-                    self.pointer(entry.script_pointer)
-                    )
-            check_and_append(pointer_list)
-        for _ in range(max_recursion_depth):
-            for script_offset in subroutine_locations:
-                pointer_list = script.pointer_offsets(
-                        self.script_at(script_offset),
-                        script_offset
-                        )
-            if not check_and_append(pointer_list):
-                break
-        return sorted(subroutine_locations)
+                self.write(Int.pack(original - hs))
+        dropped = list(merged_regions)
+        new_pointers = []
+        for offset, target in gotos:
+            goto = script.event(script.FIGHTER).from_fields(0x1C,
+                                                            target=target - hs)
+            self.seek(offset)
+            self.write(bytes(goto))
+            dropped.append((offset, offset + goto.length))
+            new_pointers.extend(script.pointer_offsets([goto], offset))
+        for p in list(self.pointer_table):
+            if any(start <= self.pointer(p) < end for start, end in dropped):
+                self.delete_pointer(p)
+        for p in new_pointers:
+            self.add_pointer(p - hs)
+        with self.transaction():
+            for start, end in reversed(merged_regions):
+                self.insert(start, amount=start - end)
+        return old_size - self.data_size
 
     def char_short_name(self):
         return self.title().replace('ftData', '')
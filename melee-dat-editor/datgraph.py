@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+A whole dat file as a graph of data blocks, for making many edits and then
+writing the file out once.
+
+The data section is split at every pointer target, so a pointer always points
+at the start of a block, and bytes can be inserted into or deleted from a
+block without anything else having to move. serialize() lays the blocks out
+again one after the other (padding aligned ones with ALIGN_PADDING) and writes
+the pointers, relocation table, root and reference nodes and string table to
+match.
+"""
+
+from bisect import bisect_right
+from collections import namedtuple
+import struct
+
+from datfiles import ALIGN_PADDING, Header, Int
+from storage import replace_file
+
+HEADER_SIZE = 0x20
+
+Node = struct.Struct('>II')
+
+Symbol = namedtuple('Symbol', 'name block offset')
+Symbol.__doc__ = """
+A root or reference node: its name in the string table and the place in the
+data it points to, as a block and an offset in it.
+"""
+
+
+class Block:
+    """A run of bytes from the data section and the pointers in it"""
+    def __init__(self, data=b'', alignment=None):
+        self.data = bytearray(data)
+        self.alignment = alignment
+        # offset in this block -> (target block, offset in the target)
+        self.pointers = {}
+        # data section offset it was read from, see DatGraph.relocation
+        self.origin = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return (f'<Block of {len(self.data)} bytes, '
+                f'{len(self.pointers)} pointers>')
+
+    def set_pointer(self, offset, target, target_offset=0):
+        """Make the word at `offset` a pointer to `target_offset` bytes into
+        block `target`"""
+        self.pointers[offset] = (target, target_offset)
+
+    def clear_pointer(self, offset):
+        """Make the word at `offset` plain data again"""
+        del self.pointers[offset]
+
+    def insert(self, offset, data):
+        """Insert bytes at `offset`, moving the pointers after them along"""
+        self.data[offset:offset] = data
+        self.pointers = {(p + len(data) if p >= offset else p): target
+                         for p, target in self.pointers.items()}
+
+    def delete(self, offset, size):
+        """Delete `size` bytes at `offset`, along with any pointers in them"""
+        del self.data[offset:offset+size]
+        self.pointers = {(p - size if p >= offset else p): target
+                         for p, target in self.pointers.items()
+                         if not offset - 4 < p < offset + size}
+
+
+class DatGraph:
+    """
+    The blocks of a dat file's data section, in file order, plus its root
+    and reference nodes. Blocks can be edited, added, removed and reordered
+    freely, as long as everything that's pointed at stays in `blocks`.
+    """
+    def __init__(self, blocks=None, roots=None, refs=None,
+                 header_extra=bytes(12)):
+        self.blocks = blocks if blocks is not None else []
+        self.roots = roots if roots is not None else []
+        self.refs = refs if refs is not None else []
+        # the last 12 bytes of the header, which are kept as they were
+        self.header_extra = header_extra
+
+    @classmethod
+    def from_file(cls, f):
+        """Build the graph for the current contents of BaseDatFile `f`"""
+        pos = f.tell()
+        f.seek(0)
+        raw = f.read()
+        f.seek(pos)
+        hs = f.header_size
+        data = raw[hs:hs+f.data_size]
+        pointers = f.pointer_targets()
+        aligned = {offset - hs: alignment
+                   for offset, alignment in f.aligned_offsets}
+        node_tables = [list(f.root_nodes), list(f.ref_nodes)]
+        starts = {0}
+        starts.update(target for p, target in pointers)
+        starts.update(node.pointer for nodes in node_tables for node in nodes)
+        starts.update(aligned)
+        starts = sorted(start for start in starts if 0 <= start < len(data))
+        ends = starts[1:] + [len(data)]
+        blocks = [Block(data[start:end], aligned.get(start))
+                  for start, end in zip(starts, ends)]
+        for block, start in zip(blocks, starts):
+            block.origin = start
+        # old padding in front of aligned blocks is made again by serialize
+        padding = Int.pack(ALIGN_PADDING)
+        locations = {p for p, target in pointers}
+        for block, start, next_block in zip(blocks, starts, blocks[1:]):
+            if next_block.alignment:
+                while (block.data.endswith(padding)
+                       and start + len(block) - 4 not in locations):
+                    del block.data[-4:]
+
+        def place(offset):
+            i = max(bisect_right(starts, offset) - 1, 0)
+            return blocks[i], offset - starts[i]
+
+        for p, target in pointers:
+            block, offset = place(p)
+            block.set_pointer(offset, *place(target))
+        strings_start = f.ref_nodes.end_offset
+
+        def symbols(nodes):
+            found = []
+            for node in nodes:
+                name_start = strings_start + node.str_pointer
+                name = raw[name_start:raw.index(b'\x00', name_start)]
+                found.append(Symbol(name.decode('ascii'),
+                                    *place(node.pointer)))
+            return found
+
+        return cls(blocks, symbols(node_tables[0]), symbols(node_tables[1]),
+                   raw[Header.size:hs])
+
+    def layout(self):
+        """Returns a dict of block -> data section offset for where each
+        block goes in the serialized file"""
+        offsets = {}
+        position = 0
+        for block in self.blocks:
+            if block.alignment:
+                position += -(HEADER_SIZE + position) % block.alignment
+            offsets[block] = position
+            position += len(block)
+        return offsets
+
+    def relocation(self):
+        """
+        Returns a function that maps a data section offset in the file the
+        graph was read from to where those bytes are in the layout. Offsets
+        past the end of a block that shrank go to its end, and offsets in
+        blocks that were removed go to the end of the block before them.
+        """
+        offsets = self.layout()
+        read = sorted((block.origin, i) for i, block in enumerate(self.blocks)
+                      if block.origin is not None)
+        origins = [origin for origin, i in read]
+
+        def relocate(offset):
+            i = bisect_right(origins, offset) - 1
+            if i < 0:
+                return offset
+            block = self.blocks[read[i][1]]
+            return offsets[block] + min(offset - origins[i], len(block))
+
+        return relocate
+
+    def serialize(self):
+        """Returns the bytes of the whole dat file"""
+        offsets = self.layout()
+        padding = Int.pack(ALIGN_PADDING)
+        data = bytearray()
+        for block in self.blocks:
+            amount = offsets[block] - len(data)
+            data += bytes(amount % 4) + padding*(amount//4)
+            data += block.data
+        data += bytes(-len(data) % 4)
+
+        def address(target, offset):
+            try:
+                return offsets[target] + offset
+            except KeyError:
+                raise ValueError(f'{target!r} is pointed to but is not in '
+                                 f'the file') from None
+
+        relocations = []
+        for block in self.blocks:
+            for p, (target, offset) in block.pointers.items():
+                Int.pack_into(data, offsets[block] + p,
+                              address(target, offset))
+                relocations.append(offsets[block] + p)
+        relocations.sort()
+        strings = bytearray()
+        name_offsets = {}
+        nodes = bytearray()
+        for symbol in self.roots + self.refs:
+            if symbol.name not in name_offsets:
+                name_offsets[symbol.name] = len(strings)
+                strings += symbol.name.encode('ascii') + b'\x00'
+            nodes += Node.pack(address(symbol.block, symbol.offset),
+                               name_offsets[symbol.name])
+        body = (data + struct.pack(f'>{len(relocations)}I', *relocations)
+                + nodes + strings)
+        header = Header.pack(HEADER_SIZE + len(body), len(data),
+                             len(relocations), len(self.roots),
+                             len(self.refs))
+        return header + self.header_extra + body
+
+    def save(self, fname):
+        """Write the whole file to `fname`"""
+        replace_file(fname, self.serialize())
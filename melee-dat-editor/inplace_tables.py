@@ -13,9 +13,13 @@ On the to-do list: make everything less ugly. Because oh boy, some of it is.
 @author: rmn
 """
 
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from functools import wraps
 import struct
 from os import SEEK_CUR
+import sys
 
 
 Int = struct.Struct('>I')
@@ -28,33 +32,239 @@ class HasInPlaceTables:  # TODO: move at() here? also follow_chain()?
     start offset whenever data is inserted earlier in the file.
     """
     def __init__(self):
-        self.__tables = []
+        self.__tables = _TableRegistry()
 
     def inplace_table(self, start_offset, length, struct):
         new = _InPlaceTable(self, start_offset, length, struct)
-        self.__tables.append(new)
+        self.__tables.add(new)
+        return new
+
+    def inplace_int_table(self, start_offset, length):
+        new = _IntTable(self, start_offset, length)
+        self.__tables.add(new)
         return new
 
     def inplace_struct(self, start_offset, struct, names=None):
         new = _InPlaceStruct(self, start_offset, struct, names)
-        self.__tables.append(new)
+        self.__tables.add(new)
         return new
 
     def update_table_offsets(self, location, amount):
-        for table in self.__tables:
-            if table.start_offset >= location:
-                table.start_offset += amount
+        self.__tables.shift(location, amount)
+
+    def remap_table_offsets(self, mapping):
+        """Move every table to mapping(start_offset), for when data has been
+        moved around by more than a single insert"""
+        self.__tables.remap(mapping)
 
     def remove_inplace_table(self, table):
         self.__tables.remove(table)
         del table
 
 
+class _TableBucket:
+    __slots__ = ('registry', 'tables', 'delta')
+
+    def __init__(self, registry, tables=(), delta=0):
+        self.registry = registry
+        self.tables = list(tables)
+        # added to the stored offset of every table in the bucket
+        self.delta = delta
+
+
+class _TableRegistry:
+    """
+    The in-place tables of a HasInPlaceTables, sorted by start offset.
+
+    Neighbouring tables are grouped into buckets, and a table's start offset
+    is stored relative to its bucket. A shift only goes through the tables
+    of a bucket that has tables on both sides of it; every bucket after that
+    just has its offset adjusted, and the tables in it pick the change up
+    the next time their start_offset is read.
+    """
+    BUCKET_SIZE = 64
+
+    def __init__(self):
+        self.buckets = []
+
+    def __iter__(self):
+        for bucket in list(self.buckets):
+            yield from list(bucket.tables)
+
+    def __len__(self):
+        return sum(len(bucket.tables) for bucket in self.buckets)
+
+    def add(self, table):
+        start = table.start_offset
+        firsts = [bucket.tables[0].start_offset for bucket in self.buckets]
+        i = max(bisect_right(firsts, start) - 1, 0)
+        if not self.buckets:
+            self.buckets.append(_TableBucket(self))
+        bucket = self.buckets[i]
+        _place(table, bucket, start - bucket.delta)
+        offsets = [t._offset for t in bucket.tables]
+        bucket.tables.insert(bisect_right(offsets, table._offset), table)
+        if len(bucket.tables) > 2*self.BUCKET_SIZE:
+            tables = bucket.tables
+            bucket.tables = tables[:self.BUCKET_SIZE]
+            self.buckets.insert(i+1, _TableBucket(
+                    self, tables[self.BUCKET_SIZE:], bucket.delta))
+            for t in tables[self.BUCKET_SIZE:]:
+                _place(t, self.buckets[i+1], t._offset)
+
+    def remove(self, table):
+        bucket = table._bucket
+        if bucket is None or bucket.registry is not self:
+            raise ValueError(f'{table!r} is not registered')
+        bucket.tables.remove(table)
+        _place(table, None, table._offset + bucket.delta)
+        if not bucket.tables:
+            self.buckets.remove(bucket)
+
+    def move(self, table, start_offset):
+        """Set the start offset of a registered table"""
+        self.remove(table)
+        _place(table, None, start_offset)
+        self.add(table)
+
+    def shift(self, location, amount):
+        """Move every table that starts at or after `location` by `amount`"""
+        for bucket in self.buckets:
+            tables = bucket.tables
+            if tables[-1]._offset + bucket.delta < location:
+                continue
+            if tables[0]._offset + bucket.delta >= location:
+                bucket.delta += amount
+                continue
+            for table in tables:
+                if table._offset + bucket.delta >= location:
+                    _place(table, bucket, table._offset + amount)
+            if amount < 0:
+                tables.sort(key=lambda t: t._offset)
+
+    def remap(self, mapping):
+        """Move every table to mapping(start_offset)"""
+        tables = list(self)
+        offsets = [mapping(table.start_offset) for table in tables]
+        self.buckets = []
+        for table, offset in zip(tables, offsets):
+            _place(table, None, offset)
+            self.add(table)
+
+
+def _place(table, bucket, offset):
+    object.__setattr__(table, '_bucket', bucket)
+    object.__setattr__(table, '_offset', offset)
+
+
+class ShiftMap:
+    """
+    Several inserts/deletes merged into a single offset mapping.
+
+    Each shift is stored at the location it happened, converted back to the
+    offsets from before any of the shifts, so mapping an old offset to its
+    new one is a bisect into the sorted locations plus a lookup into the
+    prefix-summed amounts. Like BaseDatFile.insert, a shift at `location`
+    moves every offset >= location. A location can have one entry for bytes
+    inserted there followed by one for old bytes deleted from it.
+    """
+    def __init__(self, location=None, amount=0):
+        self.locations = []
+        self.amounts = []
+        # totals[i] (the sum of amounts[:i]) is _totals[i] + _base, and
+        # _ends[i] + _base is where old offset locations[i] ends up before
+        # the shift there. Keeping _base apart lets add() update whichever
+        # side of a new shift is shorter, so adding shifts from the start of
+        # the file to the end or from the end to the start are both cheap.
+        self._totals = [0]
+        self._ends = []
+        self._base = 0
+        if location is not None:
+            self.add(location, amount)
+
+    @property
+    def totals(self):
+        return [total + self._base for total in self._totals]
+
+    def add(self, location, amount):
+        """
+        Record a shift of `amount` bytes at `location`, where `location` is an
+        offset in the file as it is now (after every shift already recorded).
+        """
+        # a delete is recorded a run at a time, where the runs are the bytes
+        # inserted at one location and the old bytes between those
+        while amount < 0:
+            end, inserted = self._run_end(location)
+            size = min(-amount, end - location)
+            self._add(location, -size, inserted)
+            amount += size
+        if amount > 0:
+            self._add(location, amount, True)
+
+    def _run_end(self, location):
+        """Returns where the run `location` is in ends, and whether it is a
+        run of inserted bytes"""
+        i = bisect_right(self._ends, location - self._base)
+        if i > 0 and self.amounts[i-1] > 0:
+            inserted_end = self._ends[i-1] + self._base + self.amounts[i-1]
+            if location < inserted_end:
+                return inserted_end, True
+        if i < len(self._ends):
+            return self._ends[i] + self._base, False
+        return float('inf'), False
+
+    def _add(self, location, amount, inserted):
+        location = self.unmap(location)
+        # bytes inserted at a location go in front of the old byte there, so
+        # their entry comes before any entry for deleting old bytes from it
+        if inserted:
+            i = bisect_left(self.locations, location)
+            new = (i == len(self.locations) or self.locations[i] != location
+                   or self.amounts[i] < 0)
+        else:
+            i = bisect_right(self.locations, location)
+            new = True
+        if new:
+            self.locations.insert(i, location)
+            self.amounts.insert(i, 0)
+            self._totals.insert(i+1, self._totals[i])
+            self._ends.insert(i, location + self._totals[i])
+        self.amounts[i] += amount
+        # every total and end after the shift goes up by `amount`
+        if len(self.amounts) - i - 1 <= i:
+            self._totals[i+1:] = [t + amount for t in self._totals[i+1:]]
+            self._ends[i+1:] = [e + amount for e in self._ends[i+1:]]
+        else:
+            self._base += amount
+            self._totals[:i+1] = [t - amount for t in self._totals[:i+1]]
+            self._ends[:i+1] = [e - amount for e in self._ends[:i+1]]
+
+    def unmap(self, location):
+        """Return the smallest old offset that maps to `location` or later"""
+        i = bisect_right(self._ends, location - self._base)
+        old = location - self._totals[i] - self._base
+        return old if i == 0 else max(self.locations[i-1], old)
+
+    def is_deleted(self, offset):
+        """True if the byte at old offset `offset` was deleted"""
+        i = bisect_right(self.locations, offset) - 1
+        return (i >= 0 and self.amounts[i] < 0
+                and offset < self.locations[i] - self.amounts[i])
+
+    def __call__(self, offset):
+        i = bisect_right(self.locations, offset)
+        return offset + self._totals[i] + self._base
+
+    def __bool__(self):
+        return any(self.amounts)
+
+
 # TODO: make everything less ugly
 def preserve_pos(f):
     """
     Decorator to make a function preserve the prior file cursor position
     """
+    @wraps(f)
     def decorated(self, *args, **kw):
         pos = self.f.tell()
         ret = f(self, *args, **kw)
@@ -63,6 +273,25 @@ def preserve_pos(f):
     return decorated
 
 
+class lazy_property:
+    """
+    Decorator for a property that is computed on first access and then
+    stored on the instance, so later accesses are plain attribute lookups.
+    Deleting the attribute makes it recompute on the next access.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.name = f.__name__
+        self.__doc__ = f.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.f(instance)
+        instance.__dict__[self.name] = value
+        return value
+
+
 # TODO: rewrite to allow chain links to be names, passed as strings?
 @preserve_pos
 def follow_chain(self, chain):
@@ -96,7 +325,28 @@ def at(offset, fmt='I'):
     return property(getter, setter)
 
 
-class _InPlaceTable:
+class _Registered:
+    """
+    Start offset handling for anything kept in a _TableRegistry. While a
+    table is registered, its offset is stored relative to its bucket.
+    """
+    __slots__ = ('_offset', '_bucket')
+
+    @property
+    def start_offset(self):
+        if self._bucket is None:
+            return self._offset
+        return self._offset + self._bucket.delta
+
+    @start_offset.setter
+    def start_offset(self, value):
+        if self._bucket is None:
+            _place(self, None, value)
+        else:
+            self._bucket.registry.move(self, value)
+
+
+class _InPlaceTable (_Registered):
     """
     Index by position in the table. [key, subkey] indexing can be used to
     index into the struct at that position. subkey can be positional index or
@@ -105,7 +355,7 @@ class _InPlaceTable:
     """
     def __init__(self, f, offset, length, struct):
         self.f = f
-        self.start_offset = int(offset)
+        _place(self, None, int(offset))
         self.length = int(length)
         self.item_size = struct.size
         self.struct = struct
@@ -196,27 +446,10 @@ class _InPlaceTable:
     # TODO: fix argument out of range error
     def __delitem__(self, key):
         """use with care: does not update pointers"""
-
-        print(hex(self.start_offset))
-        pos = self.f.tell()
-        self.f.seek(0x420c)
-        print(hex(Int.unpack(self.f.read(4))[0]))
-        self.f.seek(pos)
-
-
-        print(hex(self.start_offset))
         key = self._process_key(key)
-        print(hex(self.get_offset(key)))
         self.f.insert(self.get_offset(key), amount=-self.item_size)
         self.length -= 1
 
-
-        print(hex(self.start_offset))
-        pos = self.f.tell()
-        self.f.seek(0x420c)
-        print(hex(Int.unpack(self.f.read(4))[0]))
-        self.f.seek(pos)
-
     def __str__(self):
         return '[' + ', '.join(str(val) for val in self) + ']'
 
@@ -232,12 +465,118 @@ class _InPlaceTable:
         return self.start_offset + len(self)*self.item_size
 
 
-class _InPlaceStruct:
-    __slots__ = ('f', 'start_offset', 'struct', 'names')
+class _IntTable (_InPlaceTable):
+    """
+    In-place table of big-endian unsigned ints, mirrored in memory by an
+    array('I') that is kept in sync with every change made through the table.
+    Reads never touch the file, and while the table is in ascending order
+    (as the relocation table should be), membership tests, sorted insertion
+    and deletion by value are all bisects.
+    """
+    def __init__(self, f, offset, length):
+        super().__init__(f, offset, length, Int)
+        self.f.seek(self.start_offset)
+        self.values = array('I', self.f.read(self.length*self.item_size))
+        if sys.byteorder == 'little':
+            self.values.byteswap()
+        self.is_sorted = all(a <= b for a, b in
+                             zip(self.values, self.values[1:]))
+
+    def _check_sorted(self, key):
+        if self.is_sorted:
+            v = self.values
+            self.is_sorted = ((key == 0 or v[key-1] <= v[key]) and
+                              (key == len(v)-1 or v[key] <= v[key+1]))
+
+    def insert_sorted(self, value):
+        """for pointer table"""
+        if self.is_sorted:
+            i = bisect_right(self.values, value)
+        else:
+            i = next((i for i, val in enumerate(self.values) if val > value),
+                     len(self.values))
+        if i == len(self.values):
+            self.append(value)
+        else:
+            self.insert(i, value)
+
+    def delete_by_value(self, value):
+        """Delete the first instance of `value`. Used for pointer table."""
+        del self[self.index(value)]
+
+    def index(self, value):
+        if self.is_sorted:
+            i = bisect_left(self.values, value)
+            if i < len(self.values) and self.values[i] == value:
+                return i
+        else:
+            try:
+                return self.values.index(value)
+            except ValueError:
+                pass
+        raise ValueError(f"{value} not found in table")
+
+    def append(self, value):
+        super().append(value)
+        self.values.append(value)
+        self._check_sorted(len(self.values) - 1)
+
+    def insert(self, key, value):
+        key = self._process_key(key)
+        super().insert(key, value)
+        self.values.insert(key, value)
+        self._check_sorted(key)
+
+    @preserve_pos
+    def assign(self, values):
+        """Replace every entry at once with a single write"""
+        values = array('I', values)
+        if len(values) != self.length:
+            raise ValueError("Number of values does not match table length")
+        data = array('I', values)
+        if sys.byteorder == 'little':
+            data.byteswap()
+        self.f.seek(self.start_offset)
+        self.f.write(data.tobytes())
+        self.values = values
+        self.is_sorted = all(a <= b for a, b in zip(values, values[1:]))
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.values[self._process_key(key)]
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if isinstance(key, int) and not hasattr(value, '__len__'):
+            key = self._process_key(key)
+            self.values[key] = value
+        else:
+            key = self._process_key(key)
+            self.values[key] = super().__getitem__(key)
+        self._check_sorted(key)
+
+    def __delitem__(self, key):
+        key = self._process_key(key)
+        super().__delitem__(key)
+        del self.values[key]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __contains__(self, value):
+        if self.is_sorted:
+            i = bisect_left(self.values, value)
+            return i < len(self.values) and self.values[i] == value
+        return value in self.values
+
+
+class _InPlaceStruct (_Registered):
+    __slots__ = ('f', 'struct', 'names')
 
     def __init__(self, f, offset, struct, names=None):
         object.__setattr__(self, 'f', f)
-        object.__setattr__(self, 'start_offset', int(offset))
+        _place(self, None, int(offset))
         object.__setattr__(self, 'struct', struct)
         object.__setattr__(self, 'names', names)
 
@@ -260,7 +599,7 @@ class _InPlaceStruct:
         return getattr(self.struct.unpack(self.f.read(self.struct.size)), name)
 
     def __setattr__(self, name, value):
-        if name in self.__slots__:
+        if name in self.__slots__ or name == 'start_offset':
             return object.__setattr__(self, name, value)
         else:
             key = self.struct.ntuple._fields.index(name)
@@ -378,7 +378,7 @@ class ScriptEditor (QWidget):
             return
         offset = int(offset_hex_text, base=16)
         self.event_list.start_offset = offset
-        for ev, offset in script.iter_script(self.f.script_at(offset), offset):
+        for ev, offset in self.f.decode_script_at(offset):
             self.event_list.add_event(ev, offset)
 
     def apply(self):
@@ -971,12 +971,13 @@ class HurtboxEditor (QWidget):
 
     def set_n_hurtboxes(self, n):
         prev_n = self.hurtbox_header.n_hurtboxes
-        if n < prev_n:
-            for _ in range(prev_n - n):
-                del self.hurtbox_table[-1]
-        elif n > prev_n:
-            for _ in range(n - prev_n):
-                self.hurtbox_table.append([0]*10)
+        with self.hurtbox_table.f.transaction():
+            if n < prev_n:
+                for _ in range(prev_n - n):
+                    del self.hurtbox_table[-1]
+            elif n > prev_n:
+                for _ in range(n - prev_n):
+                    self.hurtbox_table.append([0]*10)
 
         self.hurtbox_header.n_hurtboxes = n
         self.populate_table()
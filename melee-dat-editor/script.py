@@ -6,13 +6,19 @@ Created on Thu Dec 13 23:18:39 2018
 """
 
 import binascii
+from collections import defaultdict
 from enum import Enum
 from io import BytesIO
 from math import ceil
 import os
 import struct
 
-import yaml
+try:
+    import numpy as np
+except ImportError:  # optional, only needed for extract_fields
+    np = None
+
+import yaml_cache
 
 Float = struct.Struct('>f')
 Int = struct.Struct('>I')
@@ -26,11 +32,11 @@ fighter_event_types_fname = os.path.join(folder, 'fighter-events.yml')
 article_event_types_fname = os.path.join(folder, 'article-events.yml')
 custom_fname = os.path.join(folder, 'fighter-events-custom.yml')
 
-fighter_event_types = yaml.safe_load(open(fighter_event_types_fname, 'r'))
-article_event_types = yaml.safe_load(open(article_event_types_fname, 'r'))
-control_event_types = yaml.safe_load(open(control_event_types_fname, 'r'))
+fighter_event_types = yaml_cache.load(fighter_event_types_fname)
+article_event_types = yaml_cache.load(article_event_types_fname)
+control_event_types = yaml_cache.load(control_event_types_fname)
 
-custom_event_types = yaml.safe_load(open(custom_fname, 'r'))
+custom_event_types = yaml_cache.load(custom_fname)
 
 fighter_event_types.update(control_event_types)
 for key, value in fighter_event_types.items():
@@ -53,6 +59,28 @@ lookahead_amount = max(v.bit_length() for v in keys)
 del keys
 
 
+def compile_dispatch(event_types):
+    """
+    For each base code, make a list of (bit length, set of codes) for its
+    event types, longest codes first.
+
+    find_code compares the event data shifted right by every possible amount
+    against the codes, but a code can only ever match at the one shift that
+    leaves the data with the same bit length as the code. So each distinct
+    code length needs just one shift and one set lookup, and checking the
+    longest first finds the most specific code, same as the shift loop did.
+    """
+    dispatch = {}
+    for base_code, types in event_types.items():
+        if not isinstance(base_code, int):  # 'default'
+            continue
+        by_length = defaultdict(set)
+        for code in types:
+            by_length[code.bit_length()].add(code)
+        dispatch[base_code] = sorted(by_length.items(), reverse=True)
+    return dispatch
+
+
 def read_script(file, include_terminator=False, script_type=FIGHTER):
     """
     Read from a file until reaching the 0x00000000 terminator event. Return a
@@ -79,6 +107,123 @@ def read_script(file, include_terminator=False, script_type=FIGHTER):
             return script
 
 
+def decode_script(buffer, offset=0, include_terminator=False,
+                  script_type=FIGHTER):
+    """
+    Decode the script starting at `offset` in `buffer`, which can be bytes or
+    anything else supporting the buffer protocol. Stops at the same places as
+    read_script, but works on a memoryview with an integer cursor instead of
+    reading and seeking a file.
+
+    Returns a list of (event, offset) pairs, like iter_script. No views of
+    `buffer` are kept once this returns, so a BytesIO's getbuffer() can be
+    passed in and released afterwards.
+    """
+    cls = event(script_type)
+    script = []
+    with memoryview(buffer) as view:
+        end = len(view)
+        while offset < end:
+            code = cls.find_code(view[offset:offset+lookahead_amount])
+            length = cls.get_evtype(*code)['length']
+            ev = cls(view[offset:offset+length])
+            script.append((ev, offset))
+            offset += length
+            if not ev:
+                return script if include_terminator else script[:-1]
+            if ev.code[1] in [0x18, 0x1C]:  # 0x18 = return, 0x1C = goto
+                return script
+    return script
+
+
+def find_events(buffer, scripts, code, custom_code=None, script_type=FIGHTER):
+    """
+    Find every event of the given type in the scripts in `buffer`.
+
+    `scripts` is an iterable of (label, start offset) pairs, e.g. subaction
+    numbers and script offsets. Each script is walked the same way as
+    decode_script, but only the event codes are looked at, and no Event
+    objects are made. Calls and gotos aren't followed.
+
+    Returns a list of (label, offset) pairs for the matching events.
+    """
+    if custom_code is None:
+        custom_code = code
+    cls = event(script_type)
+    found = []
+    with memoryview(buffer) as view:
+        end = len(view)
+        for label, offset in scripts:
+            while offset < end:
+                head = view[offset:offset+lookahead_amount]
+                ev_code = cls.find_code(head)
+                length = cls.get_evtype(*ev_code)['length']
+                if ev_code == [code, custom_code]:
+                    found.append((label, offset))
+                if not any(view[offset:offset+length]):
+                    break
+                if ev_code[1] in [0x18, 0x1C]:  # return, goto
+                    break
+                offset += length
+    return found
+
+
+def extract_fields(buffer, scripts, code, custom_code=None,
+                   script_type=FIGHTER):
+    """
+    Decode the fields of every event of the given type in the scripts in
+    `buffer` (see find_events) into a numpy structured array, with one row per
+    event. The 'subaction' and 'offset' columns hold the label and offset of
+    each event, and there is a column per field, named as in fieldnames().
+
+    The fields are all decoded at once with numpy rather than event by event,
+    so this is much faster than indexing Event objects when there are a lot of
+    them. Values are the same as Event.__getitem__ gives.
+    """
+    if np is None:
+        raise ImportError('extract_fields requires numpy')
+    cls = event(script_type).event_class(code, custom_code)
+    found = find_events(buffer, scripts, code, custom_code, script_type)
+    dtype = [('subaction', np.int64), ('offset', np.int64)]
+    for name, (_, _, _, value_type) in zip(cls._fieldnames, cls._accessors):
+        if value_type == 's':
+            dtype.append((name, np.int64))
+        elif value_type in ('f', 'f-upper'):
+            dtype.append((name, np.float32))
+        else:
+            dtype.append((name, np.uint32))
+    result = np.zeros(len(found), dtype=dtype)
+    if not found:
+        return result
+    labels, offsets = zip(*found)
+    result['subaction'] = labels
+    result['offset'] = offsets
+    with memoryview(buffer) as view:
+        data = np.frombuffer(view, dtype=np.uint8)
+        # one row of bytes per event
+        rows = data[result['offset'][:, None] + np.arange(cls._evtype['length'])]
+        del data
+    rows = rows.astype(np.uint64)
+    for name, (shift, mask, bit_length, value_type) in zip(cls._fieldnames,
+                                                           cls._accessors):
+        # gather just the bytes the field lies in, then shift and mask
+        high = cls._nbits - 1 - shift  # bit positions from the start
+        low = high - bit_length + 1
+        value = np.zeros(len(rows), dtype=np.uint64)
+        for byte in range(low//8, high//8 + 1):
+            value = (value << np.uint64(8)) | rows[:, byte]
+        value = (value >> np.uint64(7 - high % 8)) & np.uint64(mask)
+        if value_type == 's':
+            value = value.astype(np.int64)
+            value -= ((value >> (bit_length - 1)) & 1) << bit_length
+        elif value_type == 'f':
+            value = value.astype(np.uint32).view(np.float32)
+        elif value_type == 'f-upper':
+            value = (value << np.uint64(16)).astype(np.uint32).view(np.float32)
+        result[name] = value
+    return result
+
+
 def iter_script(list_of_events, start_offset=0):
     offset = start_offset
     for ev in list_of_events:
@@ -112,6 +257,12 @@ def script_from_hex_str(hexstr, include_terminator=False, script_type=FIGHTER):
     return script_from_bytes(binascii.unhexlify(hexstr), include_terminator, script_type)
 
 
+def normalize_fieldname(name):
+    """Field names can be given in any case, with or without spaces, dashes
+    and underscores"""
+    return name.lower().replace('-', '').replace(' ', '').replace('_', '')
+
+
 def event(script_type):
     """Returns the appropriate Event subclass"""
     if script_type is FIGHTER:
@@ -140,9 +291,24 @@ class BaseEvent:
 
     """
 
+    __slots__ = ()
+
+    # Each event type gets its own subclass of FighterEvent/ArticleEvent, made
+    # by event_class() the first time an event of that type is created. The
+    # layout of the type's fields is worked out once and stored on the class,
+    # and instances only hold the event data.
+    _family = None  # FighterEvent/ArticleEvent, for the generated classes
+    _code = ()
+    _evtype = None
+    _nbits = 0
+    _accessors = ()  # (shift, mask, bit length, type) for each field
+    _fieldnames = ()
+    _name_index = {}  # normalized field name -> index
+    pointers = ()
+
     @property
     def code(self):
-        return self._code
+        return list(self._code)
 
     @property
     def name(self):
@@ -161,41 +327,74 @@ class BaseEvent:
 
     def fieldnames(self):
         """Return a list of field names."""
-        return [fd['name'] for fd in self.fields]
+        return list(self._fieldnames)
 
     def str_values(self):
         """Return a list of strings representing a string value for each field.
         """
         strs = []
-        types = [fd['type'] for fd in self.fields]
-        for val, tp in zip(self, types):
-            if tp == 'h':
+        for val, accessor in zip(self, self._accessors):
+            if accessor[3] == 'h':
                 strs.append(hex(val))
             else:
                 strs.append(val)
         return strs
 
-    def __init__(self, bytestr):
-        self._data = self._data = int.from_bytes(bytestr, byteorder='big')
-        code, custom_code = self.find_code(bytestr)
-        self._code = [code, custom_code]
-        self._evtype = self.get_evtype(code, custom_code)
-#        print(self._evtype)
-
-        if len(bytestr) != self.length:
+    def __new__(cls, bytestr):
+        family = cls._family or cls
+        new = object.__new__(family.event_class(*family.find_code(bytestr)))
+        new._data = int.from_bytes(bytestr, byteorder='big')
+        if len(bytestr) != new.length:
             raise ValueError("Invalid input length for event '{}' (expected {}"
-                             " bytes, received {})".format(self.name,
-                                                           self.length,
+                             " bytes, received {})".format(new.name,
+                                                           new.length,
                                                            len(bytestr)))
-        self._nbits = self.length*8
+        return new
 
-        self.pointers = []  # in case of future custom event with more than 1
-        p = self._evtype.get('pointer')
+    @classmethod
+    def event_class(cls, code, custom_code=None):
+        """Returns the subclass for events of the given type"""
+        if custom_code is None:
+            custom_code = code
+        family = cls._family or cls
+        try:
+            return family._classes[code, custom_code]
+        except KeyError:
+            pass
+        evtype = family.get_evtype(code, custom_code)
+        nbits = evtype['length']*8
+        accessors = []
+        for fd in evtype['fields']:
+            low, high = fd['bits']
+            bit_length = 1 + high - low
+            accessors.append((nbits - 1 - high, (1 << bit_length) - 1,
+                              bit_length, fd['type']))
+        fieldnames = tuple(fd['name'] for fd in evtype['fields'])
+        name_index = {}
+        for i, name in enumerate(fieldnames):
+            name_index.setdefault(normalize_fieldname(name), i)
+        pointers = ()  # in case of future custom event with more than 1
+        p = evtype.get('pointer')
         if p is not None:
             try:
-                self.pointers.extend(p)
+                pointers = tuple(p)
             except TypeError:
-                self.pointers.append(p)
+                pointers = (p, )
+        new_class = type(family.__name__, (family, ), {
+                '__slots__': ('_data', ),
+                '__qualname__': family.__qualname__,
+                '__module__': family.__module__,
+                '_family': family,
+                '_code': (code, custom_code),
+                '_evtype': evtype,
+                '_nbits': nbits,
+                '_accessors': tuple(accessors),
+                '_fieldnames': fieldnames,
+                '_name_index': name_index,
+                'pointers': pointers,
+                })
+        family._classes[code, custom_code] = new_class
+        return new_class
 
 #    @staticmethod
 #    def find_code(bytestr):
@@ -215,19 +414,20 @@ class BaseEvent:
         # returns code, custom_code
         # where custom_code is the same as base_code if the event is not custom
         data = int.from_bytes(bytestr, byteorder='big')
+        data_length = data.bit_length()
+        max_shift = len(bytestr)*8 - 6
 
         base_code = bytestr[0] & 0xFC
-        if base_code in cls.event_types.keys():
-            for i in range(len(bytestr)*8 - 6):
-                try_code = (data >> i)
-                if try_code in cls.event_types[base_code].keys():
-                    return [base_code, try_code]
+        if base_code in cls.dispatch:
+            lookup_code = base_code
         else:  # allow for 0xFF customs
-            base_code2 = bytestr[0]
-            for i in range(len(bytestr)*8 - 6):
-                try_code = (data >> i)
-                if try_code in cls.event_types[base_code2].keys():
-                    return [base_code2, try_code]
+            lookup_code = bytestr[0]
+        for bit_length, codes in cls.dispatch[lookup_code]:
+            shift = data_length - bit_length
+            if shift >= max_shift:
+                break  # shifts only get bigger from here
+            if shift >= 0 and (data >> shift) in codes:
+                return [lookup_code, data >> shift]
         return [base_code, base_code]
 
     @classmethod
@@ -313,18 +513,22 @@ class BaseEvent:
         return new
 
     def copy(self):
-        return self.__class__(bytes(self))
+        new = object.__new__(self.__class__)
+        new._data = self._data
+        return new
+
+    def __reduce__(self):
+        # the per-type classes are made at runtime, so copy and pickle go
+        # through the family class, which picks the type again from the bytes
+        return (self._family or type(self), (bytes(self), ))
 
     # indexing
     def _try_fieldname_to_index(self, name):
         """Allow indexing fields by position or by name"""
-        def remove_spaces(s):
-            return s.lower().replace('-', '').replace(' ', '').replace('_', '')
         if isinstance(name, str):
             try:
-                names = [remove_spaces(s) for s in self.fieldnames()]
-                return names.index(remove_spaces(name))
-            except ValueError:
+                return self._name_index[normalize_fieldname(name)]
+            except KeyError:
                 raise ValueError("Field '{}' does not exist for "
                                  "event {}".format(name, self.name))
         else:
@@ -341,29 +545,21 @@ class BaseEvent:
                 self[k] = v
             return
         # list-like and dict-like indexing
-        key = self._try_fieldname_to_index(key)
-        value_type = self.fields[key]['type']
+        shift, mask, _, value_type = self._accessors[
+                self._try_fieldname_to_index(key)]
         if value_type == 'f':
             val = Int.unpack(Float.pack(val))[0]
         elif value_type == 'f-upper':
             val = Int.unpack(Float.pack(val))[0] >> 16
-
-
-        low, high = self.fields[key]['bits']
-        mask = 2**(1+high-low) - 1
-        shift = self._nbits - 1 - high
         self._data &= ~(mask << shift)
         self._data |= (min(val, mask) & mask) << (shift)
 
     def __getitem__(self, key):
         if isinstance(key, slice):
             return [self[k] for k in range(*key.indices(len(self)))]
-        key = self._try_fieldname_to_index(key)
-        low, high = self.fields[key]['bits']
-        bit_length = high-low + 1
-        mask = 2**(bit_length) - 1
-        value = (self._data >> (self._nbits - 1 - high)) & mask
-        value_type = self.fields[key]['type']
+        shift, mask, bit_length, value_type = self._accessors[
+                self._try_fieldname_to_index(key)]
+        value = (self._data >> shift) & mask
         if value_type == 's':
             # signed
             if (value & (1 << (bit_length - 1))):
@@ -375,7 +571,7 @@ class BaseEvent:
         return value
 
     def __len__(self):
-        return len(self.fields)
+        return len(self._accessors)
 
     def __eq__(self, other):
         if isinstance(other, (bytes, bytearray)):
@@ -418,8 +614,14 @@ class BaseEvent:
 
 
 class FighterEvent(BaseEvent):
+    __slots__ = ()
     event_types = fighter_event_types
+    dispatch = compile_dispatch(fighter_event_types)
+    _classes = {}
 
 
 class ArticleEvent(BaseEvent):
+    __slots__ = ()
     event_types = article_event_types
+    dispatch = compile_dispatch(article_event_types)
+    _classes = {}
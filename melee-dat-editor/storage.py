@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends for dat files.
+
+BaseDatFile (and everything built on HasInPlaceTables) only needs something
+with seek/read/write/tell/truncate, so the backends here all look like files.
+Keeping the data in memory means walking tables and scripts never touches the
+disk once the file has been loaded.
+"""
+
+import io
+import mmap
+import os
+from os import SEEK_END
+import shutil
+import tempfile
+
+
+class MemoryStorage (io.BytesIO):
+    """
+    Writable in-memory copy of a file. Used when opening a dat with
+    copy=True, so edits never touch the original until it is saved.
+
+    Every write is recorded as a dirty byte range, so saving back over the
+    file it was loaded from (or last saved to) only has to write the ranges
+    that changed, as long as the size is the same and nothing else has
+    modified the file since.
+    """
+    def __init__(self, initial_bytes=b''):
+        super().__init__(initial_bytes)
+        self.dirty = []
+        self.fname = None
+        self._saved_stat = None
+
+    @classmethod
+    def from_file(cls, fname):
+        with open(fname, 'rb') as file:
+            new = cls(file.read())
+        new._remember(fname)
+        return new
+
+    def write(self, data):
+        start = self.tell()
+        n = super().write(data)
+        self.dirty.append((start, start + n))
+        return n
+
+    def mark_dirty(self, start, end):
+        """For changes made directly through getbuffer()"""
+        self.dirty.append((start, end))
+
+    def dirty_ranges(self):
+        """Sorted list of merged (start, end) ranges written since the last
+        save"""
+        merged = []
+        for start, end in sorted(self.dirty):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.dirty = [tuple(r) for r in merged]
+        return self.dirty
+
+    def size(self):
+        return len(self.getbuffer())
+
+    def save(self, fname):
+        """
+        Write the contents to `fname`. Only the dirty ranges are written if
+        `fname` is unchanged since it was loaded or last saved and the size
+        is the same; otherwise the whole file is written to a temporary file
+        which then replaces `fname`.
+        """
+        with self.getbuffer() as view:
+            if self._can_patch(fname):
+                with open(fname, 'r+b') as file:
+                    for start, end in self.dirty_ranges():
+                        file.seek(start)
+                        file.write(view[start:end])
+            else:
+                replace_file(fname, view)
+        self.dirty = []
+        self._remember(fname)
+
+    def _can_patch(self, fname):
+        if (self.fname is None or not os.path.exists(fname)
+                or not os.path.exists(self.fname)):
+            return False
+        stat = os.stat(fname)
+        return (os.path.samefile(fname, self.fname)
+                and (stat.st_size, stat.st_mtime_ns) == self._saved_stat
+                and stat.st_size == self.size())
+
+    def _remember(self, fname):
+        stat = os.stat(fname)
+        self.fname = fname
+        self._saved_stat = (stat.st_size, stat.st_mtime_ns)
+
+
+class MmapStorage (mmap.mmap):
+    """
+    Read-only memory map of a file, for inspecting dat files without making
+    a copy. Any attempt to write raises TypeError.
+    """
+    def __new__(cls, fname):
+        with open(fname, 'rb') as file:
+            new = super().__new__(cls, file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        new.fname = fname
+        return new
+
+    def getbuffer(self):
+        """Same as BytesIO.getbuffer(), for parity with MemoryStorage"""
+        return memoryview(self)
+
+    def save(self, fname):
+        # nothing can have changed, so saving over the mapped file is a no-op
+        if not (os.path.exists(fname) and os.path.samefile(fname, self.fname)):
+            with self.getbuffer() as view:
+                replace_file(fname, view)
+
+
+def replace_file(fname, data):
+    """
+    Write `data` to a temporary file next to `fname`, then move it over
+    `fname`, so a failed save never leaves a half-written file behind. The
+    new file gets the old one's permissions, and a symlink is followed
+    rather than replaced.
+    """
+    fname = os.path.realpath(fname)
+    fd, temp_fname = tempfile.mkstemp(dir=os.path.dirname(fname),
+                                      suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        if os.path.exists(fname):
+            shutil.copymode(fname, temp_fname)
+        else:
+            # mkstemp makes files only the owner can read
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_fname, 0o666 & ~umask)
+        os.replace(temp_fname, fname)
+    except BaseException:
+        os.remove(temp_fname)
+        raise
+
+
+def splice(file, location, size, data=b''):
+    """
+    Replace `size` bytes at `location` in `file` with `data`.
+
+    Only the part of the file after the edit is read back and rewritten, and
+    the bytes before `location` are left alone. For MemoryStorage that is a
+    copy of the tail inside the buffer rather than a rewrite of the whole
+    file. The file position is left at the end of the file.
+    """
+    file.seek(location + size)
+    tail = file.read()
+    file.seek(location)
+    file.write(data)
+    file.write(tail)
+    file.truncate()
+    return file.seek(0, SEEK_END)
+
+
+def open_storage(fname, mode='r+b', copy=True):
+    """
+    Pick a backend for opening `fname`.
+
+    copy=True loads the whole file into memory. Otherwise the file is memory
+    mapped when opened read-only, or opened directly for any other mode so
+    that edits are written straight through to it.
+    """
+    if copy:
+        return MemoryStorage.from_file(fname)
+    if mode in ('r', 'rb'):
+        return MmapStorage(fname)
+    return open(fname, mode)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Frame-by-frame simulation of subaction scripts, for working out frame data.
+
+Frames are numbered from 1. Events before the first timer happen on frame 1,
+a Synchronous Timer of N frames moves the events after it N frames later, and
+an Asynchronous Timer of N frames moves them to frame N + 1 if that's later
+(so both count from the start of the script the same way). A hitbox is active
+from the frame its Create Hitbox event happens on up to the frame before it's
+terminated.
+
+Only what's in the script is simulated, so the timeline stops at the last
+event; how long the animation itself lasts isn't known here.
+"""
+
+from collections import namedtuple
+
+# control flow
+END_OF_SCRIPT = 0x00
+SYNCHRONOUS_TIMER = 0x04
+ASYNCHRONOUS_TIMER = 0x08
+SET_LOOP = 0x0C
+EXECUTE_LOOP = 0x10
+SUBROUTINE = 0x14
+RETURN = 0x18
+GO_TO = 0x1C
+# state
+CREATE_HITBOX = 0x2C
+ADJUST_HITBOX_DAMAGE = 0x30
+ADJUST_HITBOX_SIZE = 0x34
+TERMINATE_SPECIFIC_COLLISION = 0x3C
+TERMINATE_COLLISIONS = 0x40
+AUTOCANCEL = 0x4C
+ALLOW_INTERRUPT = 0x5C
+DISALLOW_INTERRUPT = 0x5C000001
+SET_BODY_STATE = 0x68
+
+MAX_FRAMES = 1000
+MAX_EVENTS_PER_FRAME = 10000
+
+Frame = namedtuple('Frame', 'number hitboxes interruptible body_state '
+                            'autocancel events')
+Frame.__doc__ = """
+The state during one frame. `hitboxes` is a dict of hitbox ID -> Create
+Hitbox event (with any adjustments made to it) for the active hitboxes, and
+`events` is a tuple of the events that happened on this frame. `autocancel`
+starts True and flips at each Autocancel? event.
+"""
+
+FrameData = namedtuple('FrameData', 'total_frames active iasa')
+FrameData.__doc__ = """
+Summary of a timeline: its length, a list of (first, last) frame ranges when
+any hitbox is active, and the first frame it can be interrupted on (or None).
+"""
+
+
+def simulate(events, load_script=None, max_frames=MAX_FRAMES):
+    """
+    Run the script `events` (a list of events, as from script.read_script)
+    and return its timeline, a list of Frame with one for each frame.
+
+    `load_script` is called with the target of each Subroutine and Go To
+    event (a data offset) and should return the list of events there. Scripts
+    that never end, such as ones that go back to their own start, are cut off
+    after `max_frames` frames.
+    """
+    timeline = []
+    frame = 1
+    hitboxes = {}
+    interruptible = False
+    body_state = 0
+    autocancel = True
+    frame_events = []
+    # ['loop', events, position, count] or ['call', events, position]
+    stack = []
+    current, position = events, 0
+    steps = 0
+    while position < len(current):
+        ev = current[position]
+        position += 1
+        code = ev.code[1]
+        steps += 1
+        if steps > MAX_EVENTS_PER_FRAME:
+            raise ValueError(f'Script loops on frame {frame} without waiting')
+        if code in (SYNCHRONOUS_TIMER, ASYNCHRONOUS_TIMER):
+            if code == SYNCHRONOUS_TIMER:
+                next_frame = frame + ev['frames']
+            else:
+                next_frame = max(frame, ev['frames'] + 1)
+            next_frame = min(next_frame, max_frames + 1)
+            while frame < next_frame:
+                timeline.append(Frame(frame, hitboxes, interruptible,
+                                      body_state, autocancel,
+                                      tuple(frame_events)))
+                frame_events = []
+                frame += 1
+                steps = 0
+            if frame > max_frames:
+                return timeline
+            continue
+        if code == END_OF_SCRIPT:
+            break
+        elif code == SET_LOOP:
+            stack.append(['loop', current, position, ev['loop count']])
+        elif code == EXECUTE_LOOP:
+            if stack and stack[-1][0] == 'loop':
+                loop = stack[-1]
+                loop[3] -= 1
+                if loop[3] > 0:
+                    current, position = loop[1], loop[2]
+                else:
+                    stack.pop()
+        elif code in (SUBROUTINE, GO_TO):
+            if load_script is None:
+                raise ValueError('No way to load the script at '
+                                 f'{hex(ev["target"])}')
+            if code == SUBROUTINE:
+                stack.append(['call', current, position])
+            current, position = load_script(ev['target']), 0
+        elif code == RETURN:
+            while stack and stack[-1][0] != 'call':
+                stack.pop()
+            if not stack:
+                break
+            _, current, position = stack.pop()
+        else:
+            frame_events.append(ev)
+            # hitboxes is copied whenever it changes, so frames can share it
+            if code == CREATE_HITBOX:
+                hitboxes = dict(hitboxes)
+                hitboxes[ev['id']] = ev
+            elif code in (ADJUST_HITBOX_DAMAGE, ADJUST_HITBOX_SIZE):
+                hitbox = hitboxes.get(ev['hitbox id'])
+                if hitbox is not None:
+                    if code == ADJUST_HITBOX_DAMAGE:
+                        field = 'damage'
+                    else:
+                        field = 'size'
+                    hitbox = hitbox.copy()
+                    hitbox[field] = ev[field]
+                    hitboxes = dict(hitboxes)
+                    hitboxes[ev['hitbox id']] = hitbox
+            elif code == TERMINATE_SPECIFIC_COLLISION:
+                hitboxes = {i: hitbox for i, hitbox in hitboxes.items()
+                            if i != ev['hitbox id']}
+            elif code == TERMINATE_COLLISIONS:
+                hitboxes = {}
+            elif code == ALLOW_INTERRUPT:
+                interruptible = True
+            elif code == DISALLOW_INTERRUPT:
+                interruptible = False
+            elif code == SET_BODY_STATE:
+                body_state = ev['body state']
+            elif code == AUTOCANCEL:
+                autocancel = not autocancel
+    timeline.append(Frame(frame, hitboxes, interruptible, body_state,
+                          autocancel, tuple(frame_events)))
+    return timeline
+
+
+def frame_data(timeline):
+    """Returns the FrameData for a timeline from simulate()"""
+    active = []
+    iasa = None
+    for fr in timeline:
+        if fr.hitboxes:
+            if active and active[-1][1] == fr.number - 1:
+                active[-1] = (active[-1][0], fr.number)
+            else:
+                active.append((fr.number, fr.number))
+        if iasa is None and fr.interruptible:
+            iasa = fr.number
+    return FrameData(len(timeline), active, iasa)
+
+
+def simulate_file(f, max_frames=MAX_FRAMES):
+    """
+    Simulate every subaction script in moveset dat file `f`. Returns a dict
+    of subaction number -> timeline. Subactions that share a script share
+    its timeline. A subaction whose script can't be simulated, such as one
+    that loops without waiting, gets the ValueError instead.
+    """
+    scripts = {}
+
+    def load_script(target):
+        try:
+            return scripts[target]
+        except KeyError:
+            scripts[target] = f.script_at(f.pointer(target))
+            return scripts[target]
+
+    by_offset = {}
+    timelines = {}
+    for i, subaction in f.iter_subactions():
+        offset = subaction.script_pointer
+        if offset not in by_offset:
+            try:
+                by_offset[offset] = simulate(load_script(offset),
+                                             load_script, max_frames)
+            except ValueError as e:
+                by_offset[offset] = e
+        timelines[i] = by_offset[offset]
+    return timelines
+
+
+def frame_data_table(f, max_frames=MAX_FRAMES):
+    """Returns a dict of subaction number -> FrameData for every subaction
+    in moveset dat file `f`, or the ValueError from simulate_file"""
+    return {i: (timeline if isinstance(timeline, ValueError)
+                else frame_data(timeline))
+            for i, timeline in simulate_file(f, max_frames).items()}
@@ -4,15 +4,32 @@ Unit tests for Melee Dat Editor. Incomplete so far but better than nothing;
 intend to improve them over time.
 """
 
+import copy
 import os
 import os.path as osp
+import pickle
+import struct
+import tempfile
 import unittest
 import re
 
+import assembler
+import attributes
 import datfiles
+import datgraph
+try:
+    import fsm
+except ImportError:  # fsm.py needs PyQt5 for its widgets
+    fsm = None
+import script
+import storage
+import timeline
+import yaml_cache
 
 
 iso_dump_directory = osp.expanduser(r'~/SSB/melee-hacks/iso-dump/root')  # change as needed
+fsm_templates = osp.join(osp.dirname(osp.abspath(__file__)),
+                         'data', 'fsm-templates')
 
 
 class TestVanillaDatLoading (unittest.TestCase):
@@ -32,5 +49,836 @@ class TestVanillaDatLoading (unittest.TestCase):
                 f = datfiles.moveset_datfile(osp.join(iso_dump_directory, fn))
 
 
+def make_test_dat(data_words, pointer_offsets, title='testData'):
+    """
+    Write a minimal dat file with the given data section and relocation
+    table and a single root node pointing at offset 0, and return its name.
+    """
+    data = b''.join(struct.pack('>I', w) for w in data_words)
+    body = (data
+            + b''.join(struct.pack('>I', p) for p in pointer_offsets)
+            + struct.pack('>II', 0, 0)
+            + title.encode('ascii') + b'\x00')
+    header = struct.pack('>IIIII12x', 0x20 + len(body), len(data),
+                         len(pointer_offsets), 1, 0)
+    fd, fname = tempfile.mkstemp(suffix='.dat')
+    with os.fdopen(fd, 'wb') as file:
+        file.write(header + body)
+    return fname
+
+
+def make_test_moveset(subactions, *extra, title='ftDataTest'):
+    """
+    Write a minimal moveset dat file and return its name. `subactions` are
+    the subaction scripts and `extra` any other blocks, as (label, items)
+    pairs that are laid out one after the other in that order. Items are
+    hex strings of data, or '&label' for a pointer to that block. A block
+    labelled 'articles' is used as the article list.
+    """
+    def zeros(fmt):
+        return ['00000000'] * (struct.calcsize(fmt) // 4)
+
+    blocks = [('index', ['&common', '&unique', '0'*8, '&subactions', '0'*8,
+                         '&nonlocal', '0'*8, '&nonlocal_end', '0'*32,
+                         '&hurtbox_header', '0'*32, '&ledge',
+                         '&articles' if 'articles' in dict(extra) else '0'*8,
+                         '0'*32, '&model']),
+              ('common', zeros(attributes.common_table('default')[1])),
+              ('unique', zeros(attributes.unique_table(
+                      title.replace('ftData', ''))[1])),
+              ('subactions', [item for label, items in subactions
+                              for item in ('&name', '0'*16, '&' + label,
+                                           '0'*16)]),
+              # an empty nonlocal table, and the pointer to where it ends
+              ('nonlocal', ['0'*8, '&nonlocal']),
+              ('nonlocal_end', ['&nonlocal']),
+              ('hurtbox_header', ['00000001', '&hurtboxes']),
+              ('hurtboxes', ['00000002', '0'*16, '3f800000'*7]),
+              ('ledge', ['0'*32, '3f800000', '40000000', '40400000']),
+              ('model', ['0'*128]),
+              ('name', [b'PlyTest_Share_ACTION_Wait_figatree'.hex(), '00']),
+              *subactions, *extra]
+    data = bytearray()
+    offsets = {}
+    pointers = {}
+    for label, items in blocks:
+        data += bytes(-len(data) % 4)
+        offsets[label] = len(data)
+        for item in items:
+            if item.startswith('&'):
+                pointers[len(data)] = item[1:]
+                item = '00000000'
+            data += bytes.fromhex(item)
+    data += bytes(-len(data) % 4)
+    for p, label in pointers.items():
+        struct.pack_into('>I', data, p, offsets[label])
+    words = struct.unpack(f'>{len(data)//4}I', data)
+    return make_test_dat(words, sorted(pointers), title)
+
+
+class DatFileTestCase (unittest.TestCase):
+    """Sets up the small dat file from make_test_dat for each test"""
+    # words 0, 2 and 5 are pointers to 0x18, 0x8 and 0x0
+    words = [0x18, 0, 0x8, 0xAAAA, 0xBBBB, 0x0, 0xCCCC, 0xDDDD]
+    pointers = [0x0, 0x8, 0x14]
+
+    def setUp(self):
+        self.fname = make_test_dat(self.words, self.pointers)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+
+class TestPointerRelocation (DatFileTestCase):
+    edits = [(0x28, 8), (0x34, -4), (0x20 + 0x18, 4), (0x24, -4)]
+
+    def test_insert(self):
+        f = datfiles.BaseDatFile(self.fname)
+        f.insert(0x20 + 0x8, data=b'\x11'*4)
+        self.assertEqual(list(f.pointer_table), [0x0, 0xC, 0x18])
+        f.seek(0x20)
+        self.assertEqual(f.read_int(), 0x1C)
+        f.seek(0x20 + 0xC)
+        self.assertEqual(f.read_int(), 0xC)
+        self.assertEqual(f.data_size, 0x24)
+
+    def test_pointer_table_mirror(self):
+        f = datfiles.BaseDatFile(self.fname)
+        f.add_pointer(0x1C)
+        f.add_pointer(0x4)
+        f.delete_pointer(0x8)
+        self.assertTrue(f.is_valid_pointer(0x20 + 0x1C))
+        self.assertFalse(f.is_valid_pointer(0x20 + 0x8))
+        self.assertEqual(list(f.pointer_table), [0x0, 0x4, 0x14, 0x1C])
+        f.seek(f.pointer_table.start_offset)
+        on_disk = struct.unpack('>4I', f.read(16))
+        self.assertEqual(list(on_disk), list(f.pointer_table))
+        self.assertEqual(f.n_pointers, 4)
+
+    def test_header_cache(self):
+        f = datfiles.BaseDatFile(self.fname)
+        self.assertEqual(f.n_pointers, 3)
+        f.n_pointers = 5
+        self.assertEqual(f.peek_at(8, 4), struct.pack('>I', 5))
+        f.seek(8)
+        f.write(struct.pack('>I', 7))
+        self.assertEqual(f.n_pointers, 7)
+
+    def test_target_index(self):
+        f = datfiles.BaseDatFile(self.fname)
+        self.assertEqual(f.next_target(0x20), 0x28)
+        self.assertEqual(f.referrers(0x28), [0x28])
+        self.assertEqual(f.referrers(0x20), [0x34])
+        self.assertEqual(f.block_size(0x28), 0x10)
+        self.assertEqual(f.block_size(0x38), 0x8)
+        f.insert(0x20 + 0x8, 4)
+        self.assertEqual(f.next_target(0x20), 0x2C)
+
+    def test_target_index_updates(self):
+        f = datfiles.BaseDatFile(self.fname)
+        index = f.target_index
+        f.insert(0x20 + 0x8, 4)
+        f.seek(0x20 + 0x18)  # the pointer to 0x0, which moved to 0x18
+        f.write(struct.pack('>I', 0x10))
+        f.add_pointer(0x4)
+        f.delete_pointer(0x0)
+        self.assertIs(f.target_index, index)
+        fresh = datfiles._TargetIndex(f.pointer_targets())
+        self.assertEqual(index.pointers, fresh.pointers)
+        self.assertEqual(index.targets, fresh.targets)
+        self.assertEqual(f.referrers(0x30), [0x38])
+
+    def test_transaction_matches_separate_inserts(self):
+        separate = datfiles.BaseDatFile(self.fname)
+        for location, amount in self.edits:
+            separate.insert(location, amount)
+        batched = datfiles.BaseDatFile(self.fname)
+        with batched.transaction():
+            for location, amount in self.edits:
+                batched.insert(location, amount)
+        separate.seek(0)
+        batched.seek(0)
+        self.assertEqual(separate.read(), batched.read())
+
+    @unittest.skipIf(datfiles.np is None, 'numpy is not installed')
+    def test_vectorized_relocation_matches_loop(self):
+        vectorized = datfiles.BaseDatFile(self.fname)
+        with vectorized.transaction():
+            for location, amount in self.edits:
+                vectorized.insert(location, amount)
+        np, datfiles.np = datfiles.np, None
+        try:
+            loop = datfiles.BaseDatFile(self.fname)
+            with loop.transaction():
+                for location, amount in self.edits:
+                    loop.insert(location, amount)
+        finally:
+            datfiles.np = np
+        self.assertEqual(vectorized.getvalue(), loop.getvalue())
+
+
+class SizedRootDatFile (datfiles.BaseDatFile):
+    """A dat file whose root block is known to be 8 bytes long"""
+    def known_extents(self):
+        return {0x20: 0x28}
+
+
+class TestFreeSpace (DatFileTestCase):
+    def test_free_space(self):
+        free = datfiles.FreeSpaceMap()
+        free.add(0x40, 0x50)
+        free.add(0x60, 0x80)
+        free.add(0x50, 0x58)
+        self.assertEqual(list(free), [(0x40, 0x58), (0x60, 0x80)])
+        self.assertEqual(free.allocate(0x10), 0x40)  # smallest that fits
+        self.assertIsNone(free.allocate(0x40))
+        free.shift(0x44, -8)  # delete 0x44-0x4C
+        self.assertEqual(list(free), [(0x48, 0x50), (0x58, 0x78)])
+        f = datfiles.BaseDatFile(self.fname)
+        f.free_space.add(0x30, 0x38)
+        f.insert(0x28, 4)
+        self.assertEqual(list(f.free_space), [(0x34, 0x3C)])
+
+    def test_compact(self):
+        # the root block is words 0 and 1, and nothing reachable from it
+        # points at words 2 to 5
+        f = SizedRootDatFile(self.fname)
+        self.assertEqual(list(f.find_free_space()), [(0x28, 0x38)])
+        self.assertEqual(f.compact(), 0x10)
+        self.assertEqual(f.data_size, 0x10)
+        self.assertEqual(list(f.pointer_table), [0x0])
+        self.assertEqual(f.peek_at(0x20, 0x10),
+                         struct.pack('>4I', 0x8, 0, 0xCCCC, 0xDDDD))
+        self.assertEqual(f.file_size, len(f.getvalue()))
+        self.assertEqual(f.title(), 'testData')
+
+    def test_compact_keeps_block_with_orphan_target(self):
+        # word 4 points into the root block, at 0x8, and nothing else does
+        words = [0x18, 0xAAAA, 0x1111, 0x2222, 0x8, 0xFFFF, 0xBBBB, 0xCCCC]
+        fname = make_test_dat(words, [0x0, 0x10])
+        try:
+            f = datfiles.BaseDatFile(fname)
+            data = f.peek_at(0x20, 0x20)
+            self.assertEqual(list(f.find_free_space()), [])
+            self.assertEqual(f.compact(), 0)
+            self.assertEqual(f.peek_at(0x20, 0x20), data)
+        finally:
+            os.remove(fname)
+
+
+class TestDatGraph (DatFileTestCase):
+    def test_dat_graph(self):
+        f = datfiles.BaseDatFile(self.fname)
+        graph = datgraph.DatGraph.from_file(f)
+        self.assertEqual([len(block) for block in graph.blocks], [8, 16, 8])
+        self.assertEqual(graph.serialize(), f.getvalue())
+        # inserting into a block gives the same file as inserting in place
+        graph.blocks[1].insert(4, b'\x11'*4)
+        f.insert(0x20 + 0xC, data=b'\x11'*4)
+        self.assertEqual(graph.serialize(), f.getvalue())
+        graph.blocks[2].alignment = 0x20
+        rebuilt = graph.serialize()
+        self.assertEqual(struct.unpack_from('>I', rebuilt, 0x20)[0], 0x20)
+        self.assertEqual(rebuilt[0x3C:0x40], struct.pack('>I', 0xDEADBEEF))
+
+    def test_apply_graph(self):
+        f = datfiles.BaseDatFile(self.fname)
+        table = f.inplace_struct(0x20 + 0x18, datfiles.Int)
+        graph = f.to_graph()
+        graph.blocks[1].insert(4, b'\x11'*4)
+        graph.blocks[0].delete(4, 4)
+        expected = graph.serialize()
+        f.apply_graph(graph)
+        self.assertEqual(f.getvalue(), expected)
+        self.assertEqual(table.start_offset, 0x20 + 0x18)
+        self.assertEqual(list(f.pointer_table), [0x0, 0x4, 0x14])
+        self.assertEqual(f.title(), 'testData')
+        f.save(self.fname)
+        with open(self.fname, 'rb') as file:
+            self.assertEqual(file.read(), expected)
+
+
+class TestTableRegistry (DatFileTestCase):
+    def test_table_registry(self):
+        f = datfiles.BaseDatFile(self.fname)
+        # enough tables to need several buckets
+        tables = [f.inplace_struct(0x20 + (i % 8)*4, datfiles.Int)
+                  for i in range(300)]
+        f.insert(0x20 + 0x10, 8)
+        f.insert(0x20 + 0x4, -4)
+        expected = [0x20 + (i % 8)*4 for i in range(300)]
+        expected = [o + 8 if o >= 0x30 else o for o in expected]
+        expected = [o - 4 if o >= 0x24 else o for o in expected]
+        self.assertEqual([t.start_offset for t in tables], expected)
+        tables[0].start_offset = 0x40
+        f.insert(0x20, 4)
+        self.assertEqual(tables[0].start_offset, 0x44)
+        self.assertEqual(f.pointer_table.start_offset, 0x20 + f.data_size)
+
+
+class TestScriptRelocation (unittest.TestCase):
+    def setUp(self):
+        # subaction 0 jumps into the middle of subaction 1
+        self.fname = make_test_moveset(
+                [('goto', ['1c000000', '&tail']),
+                 ('script', ['04000001', '04000002'])],
+                ('tail', ['14000000', '&subroutine', '00000000']),
+                ('subroutine', ['04000003', '18000000']))
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_shrink_to_jump_target(self):
+        f = datfiles.moveset_datfile(self.fname)
+        start = f.pointer(f.subaction_table[1].script_pointer)
+        jump = f.subaction_script(0)
+        f.relocate_script(start, [script.FighterEvent.from_hex('04000001'),
+                                  script.FighterEvent.from_hex('00000000')])
+        self.assertEqual(list(f.free_space), [])
+        self.assertTrue(f.is_valid_pointer(start + 0xC))
+        self.assertEqual([bytes(ev) for ev in f.subaction_script(0)],
+                         [bytes(ev) for ev in jump])
+
+    def check_replace(self, new_script):
+        f = datfiles.moveset_datfile(self.fname)
+        start = f.pointer(f.subaction_table[1].script_pointer)
+        old_length = script.script_length(f.script_at(start))
+        before = f.getvalue()
+        amount = script.script_length(new_script) - old_length
+        f.replace_script_at(start, new_script)
+        # one splice: everything after the script is moved by `amount`
+        after = f.getvalue()
+        end = start + old_length
+        self.assertEqual(f.file_size, len(before) + amount)
+        self.assertEqual(after[end+amount:f.pointer_table.start_offset],
+                         before[end:f.pointer_table.start_offset - amount])
+        self.assertEqual(f.script_targets(start), [start + 0x14 + amount])
+        # the Go To into the script still lands on the Subroutine event,
+        # which comes after the events that changed
+        goto = f.pointer(f.subaction_table[0].script_pointer)
+        self.assertEqual(f.script_targets(goto), [start + 8 + amount])
+        self.assertEqual(f.script_at(start + 8 + amount)[0].code[0], 0x14)
+
+    def test_replace_grow(self):
+        f = datfiles.moveset_datfile(self.fname)
+        start = f.pointer(f.subaction_table[1].script_pointer)
+        self.check_replace([script.FighterEvent.from_hex('04000005')]
+                           + f.script_at(start))
+
+    def test_replace_shrink(self):
+        f = datfiles.moveset_datfile(self.fname)
+        start = f.pointer(f.subaction_table[1].script_pointer)
+        self.check_replace(f.script_at(start)[:1] + f.script_at(start)[2:])
+
+    def test_replace_drop_first(self):
+        f = datfiles.moveset_datfile(self.fname)
+        start = f.pointer(f.subaction_table[1].script_pointer)
+        self.check_replace(f.script_at(start)[1:])
+
+    def test_replace_in_transaction(self):
+        f = datfiles.moveset_datfile(self.fname)
+        start = f.pointer(f.subaction_table[1].script_pointer)
+        new_script = f.script_at(start)
+        with f.transaction():
+            f.insert(start, 4)
+            with self.assertRaises(RuntimeError):
+                f.replace_script_at(start + 4, new_script)
+
+
+class TestDeduplicateScripts (unittest.TestCase):
+    hitbox = '2c02080d0578000000000000b4990013078c000b'
+
+    def setUp(self):
+        # subactions 0 and 2 are the same, and 1 ends the same way as them
+        tail = [self.hitbox, '14000000', '&subroutine', '00000000']
+        self.fname = make_test_moveset(
+                [('first', ['08000002'] + tail),
+                 ('same_tail', ['04000009'] + tail),
+                 ('duplicate', ['08000002'] + tail)],
+                ('subroutine', ['04000003', '18000000']))
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def events(self, f, start):
+        """Bytes of the events run from `start`, following Go Tos, with
+        subroutine calls as the events of the subroutine"""
+        found = []
+        for ev in f.script_at(start):
+            if ev.code[0] == 0x1C:
+                return found + self.events(f, f.pointer(ev['target']))
+            elif ev.pointers:
+                found.append(self.events(f, f.pointer(ev['target'])))
+            else:
+                found.append(bytes(ev))
+        return found
+
+    def subaction_events(self, f):
+        return [self.events(f, f.pointer(entry.script_pointer))
+                for entry in f.subaction_table]
+
+    def test_merge_duplicates(self):
+        f = datfiles.moveset_datfile(self.fname)
+        before = self.subaction_events(f)
+        self.assertEqual(f.deduplicate_scripts(merge_tails=False), 0x24)
+        self.assertEqual(f.subaction_table[2].script_pointer,
+                         f.subaction_table[0].script_pointer)
+        self.assertEqual(self.subaction_events(f), before)
+
+    def test_merge_tails(self):
+        f = datfiles.moveset_datfile(self.fname)
+        before = self.subaction_events(f)
+        self.assertEqual(f.deduplicate_scripts(), 0x24 + 0x18)
+        jump = f.script_at(f.pointer(f.subaction_table[1].script_pointer))
+        self.assertEqual([ev.code[0] for ev in jump], [0x04, 0x1C])
+        self.assertEqual(self.subaction_events(f), before)
+
+    def test_relocation_table(self):
+        f = datfiles.moveset_datfile(self.fname)
+        f.deduplicate_scripts()
+        f.seek(f.pointer_table.start_offset)
+        on_disk = struct.unpack(f'>{f.n_pointers}I', f.read(4*f.n_pointers))
+        self.assertEqual(list(on_disk), list(f.pointer_table))
+        pointers = set(f.pointer_table)
+        for entry in f.subaction_table:
+            start = f.pointer(entry.script_pointer)
+            for p in script.pointer_offsets(f.script_at(start), start):
+                self.assertIn(p - f.header_size, pointers)
+        for p in pointers:
+            self.assertLess(f.pointer(p) - f.header_size, f.data_size)
+            f.seek(f.pointer(p))
+            self.assertLess(f.read_int(), f.data_size)
+        f.save(self.fname)
+        saved = datfiles.moveset_datfile(self.fname)
+        self.assertEqual(self.subaction_events(saved),
+                         self.subaction_events(f))
+
+
+class TestMovesetTables (unittest.TestCase):
+    def setUp(self):
+        self.fname = make_test_moveset(
+                [('wait', ['04000001', '00000000'])],
+                ('articles', ['&article']),
+                ('article', ['&article_header', '&article_attributes',
+                             '0'*8, '&variants', '&article_model', '0'*8]),
+                ('article_header', ['0'*8*0x21]),
+                ('article_attributes', ['3f800000', '3f800000']),
+                ('variants', ['0'*24, '&article_script']),
+                ('article_model', ['0'*8]),
+                ('article_script', ['04000001', '00000000']),
+                title='ftDataKoopa')
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def eager(self, f):
+        """The lazy tables' values, read straight from the file"""
+        n, table = f.read_struct(f.pointer(f.index[12]),
+                                 struct.Struct('>II'))
+        return (n, tuple(f.read_struct(f.pointer(table), f.Hurtbox)),
+                f.read_struct(f.pointer(f.index[17]),
+                              struct.Struct('>IIIIfff')))
+
+    def lazy(self, f):
+        return (f.hurtbox_header.n_hurtboxes, tuple(f.hurtbox_table[0]),
+                tuple(f.ledge_grab_data))
+
+    def test_lazy_tables(self):
+        f = datfiles.moveset_datfile(self.fname)
+        self.assertNotIn('hurtbox_table', f.__dict__)
+        expected = self.eager(f)
+        f.hurtbox_header  # made before the insert, the rest after it
+        f.insert(0x20 + 0x60, 4)
+        self.assertEqual(self.lazy(f), expected)
+        self.assertEqual(self.eager(f), expected)
+        self.assertEqual(f.hurtbox_header.start_offset,
+                         f.pointer(f.index[12]))
+        self.assertEqual(len(f.articles), 1)
+        self.assertEqual(f.articles[0].data.start_offset,
+                         f.pointer(f.index[18]) + 4)
+
+    def test_compact_drops_article_tables(self):
+        f = datfiles.moveset_datfile(self.fname)
+        lazy = self.lazy(f)
+        article = f.articles[0]
+        f.compact()
+        self.assertNotIn('articles', f.__dict__)
+        self.assertEqual(self.lazy(f), lazy)
+        # the old article's tables aren't moved by edits any more
+        offset = article.data.start_offset
+        f.insert(0x20, 4)
+        self.assertEqual(article.data.start_offset, offset)
+        self.assertEqual(f.articles[0].data.start_offset,
+                         f.pointer(f.index[18]) + 4)
+
+
+@unittest.skipIf(fsm is None, 'PyQt5 is not installed')
+class TestFSM (unittest.TestCase):
+    def test_grow_fsm_list(self):
+        f = fsm.FSMDatFile(osp.join(fsm_templates, 'FSM.dat'))
+        entry = fsm.FSM.from_fields(0x2, False, 0x155, 10, 1.5)
+        f.replace_fsm_list([entry]*2)
+        # growing a list that isn't empty has to leave the root node on it
+        f.replace_fsm_list([entry]*5)
+        self.assertEqual(f.root_nodes[0].pointer, 0)
+        self.assertEqual([bytes(x) for x in f.get_fsm_list()],
+                         [bytes(entry)]*5)
+        self.assertEqual(f.title(), 'FSMDataStandalone')
+
+
+class TestModelWalk (unittest.TestCase):
+    # two sibling JObjs pointing at each other and sharing a DObj, and a TObj
+    # that is its own sibling
+    pointer_values = {0xC: 0x40, 0x10: 0x80,  # JObj
+                      0x4C: 0x0, 0x50: 0x80,  # JObj
+                      0x88: 0x90,  # DObj
+                      0x98: 0xA8,  # MObj
+                      0xAC: 0xA8, 0xF4: 0x104,  # TObj
+                      0x104: 0x120}  # image header
+
+    def setUp(self):
+        words = [0]*(0x140//4)
+        for p, value in self.pointer_values.items():
+            words[p//4] = value
+        self.fname = make_test_dat(words, sorted(self.pointer_values))
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_walk_model(self):
+        f = datfiles.BaseDatFile(self.fname)
+        found = f.walk_model(0x20)
+        data_offsets = [[offset - 0x20 for offset in nodes] for nodes in found]
+        self.assertEqual(data_offsets, [[0x0, 0x40], [0x80], [0x90], [0xA8],
+                                        [0x104], [0x120]])
+
+
+class TestScript (unittest.TestCase):
+    def test_find_code(self):
+        cases = {'5c00000100000000': [0x5c, 0x5c000001],
+                 '5c00000000000000': [0x5c, 0x5c],
+                 '5d00000000000000': [0x5c, 0x5d],
+                 '7501000000000000': [0x74, 0x7501],
+                 'ff01000000000000': [0xff, 0xff01],
+                 '0000000000000000': [0x00, 0x00]}
+        for hexstr, code in cases.items():
+            with self.subTest(event=hexstr):
+                self.assertEqual(
+                        script.FighterEvent.find_code(bytes.fromhex(hexstr)),
+                        code)
+
+    def test_event_fields(self):
+        ev = script.FighterEvent.from_hex(
+                '2c02080d0578000000000000b4990013078c000b')
+        self.assertFalse(hasattr(ev, '__dict__'))
+        self.assertIsInstance(ev, script.FighterEvent)
+        self.assertEqual(ev['Knockback Growth'], ev['knockback_growth'])
+        copy = ev.copy()
+        copy['damage'] = 0
+        self.assertEqual(copy['damage'], 0)
+        self.assertNotEqual(ev['damage'], 0)
+        self.assertIs(type(copy), type(ev))
+        with self.assertRaises(ValueError):
+            ev['not a field']
+
+    def test_copy_and_pickle(self):
+        ev = script.FighterEvent.from_hex(
+                '2c02080d0578000000000000b4990013078c000b')
+        for copied in (copy.copy(ev), copy.deepcopy(ev),
+                       pickle.loads(pickle.dumps(ev))):
+            self.assertIs(type(copied), type(ev))
+            self.assertEqual(bytes(copied), bytes(ev))
+
+    def test_decode_script(self):
+        data = bytes.fromhex('ffffffff'  # skipped by the offset
+                             '04000001'
+                             '2c02080d0578000000000000b4990013078c000b'
+                             '00000000')
+        expected = script.script_from_bytes(data[4:], include_terminator=True)
+        decoded = script.decode_script(data, 4, include_terminator=True)
+        self.assertEqual([bytes(ev) for ev, offset in decoded],
+                         [bytes(ev) for ev in expected])
+        self.assertEqual([offset for ev, offset in decoded], [4, 8, 0x1C])
+
+    @unittest.skipIf(script.np is None, 'numpy is not installed')
+    def test_extract_fields(self):
+        hitbox = '2c02080d0578000000000000b4990013078c000b'
+        data = bytes.fromhex('04000001' + hitbox + '00000000'
+                             + hitbox + '00000000')
+        table = script.extract_fields(data, [(3, 0), (7, 0x1C)], 0x2C)
+        self.assertEqual(list(table['subaction']), [3, 7])
+        self.assertEqual(list(table['offset']), [4, 0x1C])
+        ev = script.FighterEvent.from_hex(hitbox)
+        for name in ev.fieldnames():
+            with self.subTest(field=name):
+                self.assertEqual(table[name][0], ev[name])
+
+    def test_script_cache(self):
+        data = bytes.fromhex('04000001' '00000000' '04000002' '00000000')
+        cache = datfiles._ScriptCache()
+        for offset in (0, 8):
+            cache.add(offset, script.FIGHTER,
+                      script.decode_script(data, offset, True))
+        cache.forget(8, 0xC)  # overlaps the second script only
+        self.assertIsNotNone(cache.get(0, script.FIGHTER))
+        self.assertIsNone(cache.get(8, script.FIGHTER))
+        cache.forget(4)  # insert in the middle of the first script
+        self.assertIsNone(cache.get(0, script.FIGHTER))
+
+    def test_call_graph(self):
+        graph = datfiles._CallGraph([0x100])
+        graph.set_callees(0x100, [0x200], 0x110)
+        graph.set_callees(0x200, [0x300], 0x210)  # nested call
+        graph.set_callees(0x300, [], 0x310)
+        self.assertEqual(graph.callers[0x300], {0x200})
+        self.assertTrue(graph.shift(datfiles.ShiftMap(0x180, 0x20)))
+        self.assertEqual(graph.callees[0x100], [0x220])
+        self.assertEqual(graph.callees[0x220], [0x320])
+        graph.set_callees(0x100, [], 0x110)
+        graph.prune()
+        self.assertEqual(list(graph.callees), [0x100])
+        self.assertFalse(graph.shift(datfiles.ShiftMap(0x100, -4)))
+
+
+class TestAssembler (unittest.TestCase):
+    def test_round_trip(self):
+        for hexstr in ['2c02080d0578000000000000b4990013078c000b',
+                       '04000001', '9c' + '00'*15, '00000000']:
+            with self.subTest(event=hexstr):
+                ev = script.FighterEvent.from_hex(hexstr)
+                line = assembler.format_event(ev)
+                new, references = assembler.parse_event(line)
+                self.assertEqual(bytes(new), bytes(ev))
+        unknown = script.FighterEvent.from_hex('9c' + '00'*15)
+        self.assertEqual(assembler.format_event(unknown),
+                         '0x' + bytes(unknown).hex())
+
+    def test_labels(self):
+        text = ['subaction 0x3, 0x5  # comment',
+                '    Synchronous Timer: frames=4',
+                '    Subroutine: target=@sub',
+                '    End of Script',
+                'script 0x40 @sub',
+                '    Return']
+        blocks = list(assembler.parse(text))
+        self.assertEqual([b.subactions for b in blocks], [(3, 5), ()])
+        events = assembler.resolve(blocks[0], {'sub': 0x40})
+        self.assertEqual(events[1]['target'], 0x40)
+        self.assertEqual(assembler.format_event(events[1], {0x40: 'sub'}),
+                         'Subroutine: Target=@sub')
+        with self.assertRaises(ValueError):
+            list(assembler.parse(['    Return']))
+
+    def test_numeric_target_after_resize(self):
+        fname = make_test_moveset(
+                [('grows', ['04000001', '00000000']),
+                 ('calls', ['14000000', '&subroutine', '00000000'])],
+                ('subroutine', ['04000003', '18000000']))
+        try:
+            f = datfiles.moveset_datfile(fname)
+            calls = f.pointer(f.subaction_table[1].script_pointer)
+            subroutine = f.script_targets(calls)[0]
+            text = ['subaction 0',
+                    '    Synchronous Timer: frames=1',
+                    '    Synchronous Timer: frames=2',
+                    '    End of Script',
+                    'subaction 1',
+                    f'    Subroutine: target={subroutine - 0x20:#x}',
+                    '    Synchronous Timer: frames=5',
+                    '    End of Script']
+            self.assertEqual(assembler.assemble_file(f, text), 2)
+        finally:
+            os.remove(fname)
+        calls = f.pointer(f.subaction_table[1].script_pointer)
+        self.assertEqual(f.script_targets(calls), [subroutine + 8])
+        self.assertEqual([bytes(ev).hex() for ev in f.script_at(
+                subroutine + 8)], ['04000003', '18000000'])
+
+    def test_numeric_target_after_padding(self):
+        # growing subaction 0 also pads the aligned block after the
+        # subroutine, so replacing it records two shifts
+        fname = make_test_moveset(
+                [('grows', ['04000001', '00000000']),
+                 ('calls', ['14000000', '&subroutine', '00000000'])],
+                ('subroutine', ['18000000']),
+                ('aligned', ['0'*64]))
+        try:
+            f = datfiles.moveset_datfile(fname)
+            calls = f.pointer(f.subaction_table[1].script_pointer)
+            subroutine = f.script_targets(calls)[0]
+            aligned = subroutine + 4
+            f.set_offset_aligned(aligned, 32)
+            text = ['subaction 0',
+                    '    Synchronous Timer: frames=1',
+                    '    Synchronous Timer: frames=2',
+                    '    End of Script',
+                    'subaction 1',
+                    f'    Subroutine: target={subroutine - 0x20:#x}',
+                    '    Synchronous Timer: frames=5',
+                    '    End of Script']
+            self.assertEqual(assembler.assemble_file(f, text), 2)
+        finally:
+            os.remove(fname)
+        self.assertGreater(f.aligned_offsets[0][0], aligned + 4)
+        self.assertEqual(f.aligned_offsets[0][0] % 32, 0)
+        calls = f.pointer(f.subaction_table[1].script_pointer)
+        self.assertEqual(f.script_targets(calls), [subroutine + 8])
+        self.assertEqual([bytes(ev).hex() for ev in f.script_at(
+                subroutine + 8)], ['18000000'])
+
+
+class TestTimeline (unittest.TestCase):
+    def test_simulate(self):
+        E = script.FighterEvent
+        events = [E.from_fields(0x8, frames=3),
+                  E.from_fields(0x2C, id=0, damage=10),
+                  E.from_fields(0xC, loop_count=3),
+                  E.from_fields(0x4, frames=2),
+                  E.from_fields(0x10),
+                  E.from_fields(0x3C, hitbox_id=0),
+                  E.from_fields(0x5C),
+                  E.from_fields(0x4, frames=1),
+                  E.from_fields(0x14, target=0x100),
+                  E.from_fields(0x0)]
+        subroutine = [E.from_fields(0x2C, id=1),
+                      E.from_fields(0x4, frames=2),
+                      E.from_fields(0x40),
+                      E.from_fields(0x18)]
+        frames = timeline.simulate(events, {0x100: subroutine}.__getitem__)
+        self.assertEqual(sorted(frames[10].hitboxes), [1])
+        self.assertEqual(timeline.frame_data(frames),
+                         timeline.FrameData(13, [(4, 9), (11, 12)], 10))
+
+    def test_endless_script(self):
+        E = script.FighterEvent
+        events = [E.from_fields(0x4, frames=1), E.from_fields(0x1C, target=0)]
+        frames = timeline.simulate(events, {0: events}.__getitem__,
+                                   max_frames=50)
+        self.assertEqual(len(frames), 50)
+
+    def test_asynchronous_timer(self):
+        # Fox's jab: the hitbox comes out on frame 2 and is gone after 3
+        E = script.FighterEvent
+        events = [E.from_fields(0x8, frames=1),
+                  E.from_fields(0x2C, id=0),
+                  E.from_fields(0x4, frames=2),
+                  E.from_fields(0x40),
+                  # already past frame 2, so this doesn't wait
+                  E.from_fields(0x8, frames=2),
+                  E.from_fields(0x5C),
+                  E.from_fields(0x8, frames=6)]
+        frames = timeline.simulate(events)
+        self.assertEqual(timeline.frame_data(frames),
+                         timeline.FrameData(7, [(2, 3)], 4))
+
+    def test_file_with_runaway_script(self):
+        fname = make_test_moveset([('wait', ['04000003', '00000000']),
+                                   ('runaway', ['1c000000', '&runaway'])])
+        try:
+            f = datfiles.moveset_datfile(fname)
+            table = timeline.frame_data_table(f)
+        finally:
+            os.remove(fname)
+        self.assertEqual(table[0], timeline.FrameData(4, [], None))
+        self.assertIsInstance(table[1], ValueError)
+
+
+class TestYamlCache (unittest.TestCase):
+    def test_yaml_cache(self):
+        fd, fname = tempfile.mkstemp(suffix='.yml')
+        with os.fdopen(fd, 'w') as file:
+            file.write('a: 1\n')
+        try:
+            self.assertEqual(yaml_cache.load(fname), {'a': 1})
+            self.assertTrue(osp.exists(fname + '.pickle'))
+            self.assertEqual(yaml_cache.load(fname), {'a': 1})
+            with open(fname, 'w') as file:
+                file.write('a: 22\n')
+            self.assertEqual(yaml_cache.load(fname), {'a': 22})
+        finally:
+            os.remove(fname)
+            if osp.exists(fname + '.pickle'):
+                os.remove(fname + '.pickle')
+
+
+class TestStorage (unittest.TestCase):
+    fname = osp.join(fsm_templates, 'TyMnView.dat')
+
+    def test_copy_is_in_memory(self):
+        with open(self.fname, 'rb') as file:
+            original = file.read()
+        f = datfiles.BaseDatFile(self.fname)
+        self.assertIsInstance(f.f, storage.MemoryStorage)
+        f.seek(f.header_size)
+        f.write(b'\xff'*4)
+        with open(self.fname, 'rb') as file:
+            self.assertEqual(file.read(), original)
+
+    def test_splice(self):
+        f = storage.MemoryStorage(b'abcdefgh')
+        storage.splice(f, 2, 0, b'XY')
+        self.assertEqual(f.getvalue(), b'abXYcdefgh')
+        storage.splice(f, 4, 3)
+        self.assertEqual(f.getvalue(), b'abXYfgh')
+
+    def test_incremental_save(self):
+        fname = make_test_dat([0]*8, [])
+        try:
+            f = datfiles.BaseDatFile(fname)
+            f.seek(0x24)
+            f.write(b'\x12\x34\x56\x78')
+            self.assertEqual(f.f.dirty_ranges(), [(0x24, 0x28)])
+            inode = os.stat(fname).st_ino
+            f.save(fname)
+            self.assertEqual(os.stat(fname).st_ino, inode)  # patched in place
+            self.assertEqual(f.f.dirty_ranges(), [])
+            f.insert(0x20, 4)
+            f.save(fname)
+            with open(fname, 'rb') as file:
+                self.assertEqual(file.read(), f.getvalue())
+        finally:
+            os.remove(fname)
+
+    @unittest.skipIf(os.name == 'nt', 'needs POSIX permissions')
+    def test_save_keeps_mode(self):
+        fname = make_test_dat([0]*8, [])
+        link = fname + '.link'
+        try:
+            os.chmod(fname, 0o644)
+            os.symlink(fname, link)
+            f = datfiles.BaseDatFile(link)
+            f.insert(0x20, 4)
+            f.save(link)
+            self.assertTrue(osp.islink(link))
+            self.assertEqual(os.stat(fname).st_mode & 0o777, 0o644)
+            with open(fname, 'rb') as file:
+                self.assertEqual(file.read(), f.getvalue())
+        finally:
+            os.remove(fname)
+            os.remove(link)
+
+    def test_save_after_original_removed(self):
+        fname = make_test_dat([0]*8, [])
+        copy_fname = make_test_dat([0]*8, [])
+        try:
+            f = datfiles.BaseDatFile(fname)
+            os.remove(fname)
+            f.seek(0x20)
+            f.write(b'\x12\x34\x56\x78')
+            f.save(copy_fname)
+            with open(copy_fname, 'rb') as file:
+                self.assertEqual(file.read(), f.getvalue())
+        finally:
+            os.remove(copy_fname)
+
+    def test_readonly_mmap(self):
+        f = datfiles.BaseDatFile(self.fname, mode='rb', copy=False)
+        self.assertIsInstance(f.f, storage.MmapStorage)
+        self.assertEqual(f.title(), 'FSMDataTrophy')
+        with self.assertRaises(TypeError):
+            f.write(b'\x00')
+        f.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -8,11 +8,12 @@ Created on Wed Jan 23 19:16:10 2019
 import os
 
 from PyQt5.QtWidgets import QComboBox
-import yaml
+
+import yaml_cache
 
 
 id_list_fname = os.path.join('data', 'id-lists.yml')
-id_lists = yaml.safe_load(open(id_list_fname, 'r'))
+id_lists = yaml_cache.load(id_list_fname)
 
 
 class id_combobox (QComboBox):
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Cached loading of the YAML data files.
+
+PyYAML's pure-Python loader is slow, and the event type and attribute files
+get loaded every time the editor starts (and the attribute files again for
+every file opened). So the result of loading each file is pickled next to it
+and reused for as long as the YAML doesn't change.
+"""
+
+import hashlib
+import os
+import pickle
+
+from storage import replace_file
+
+# bump to throw out every existing cache file
+CACHE_VERSION = 1
+
+
+def load(fname):
+    """
+    Same as yaml.safe_load(open(fname)), but uses the cached copy at
+    `fname` + '.pickle' when it is up to date, and writes one when not.
+
+    The cache is up to date if the YAML file's modification time and size
+    are the same as when the cache was written, or failing that (say after
+    a fresh checkout) if the contents hash the same.
+    """
+    with open(fname, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        cached = _read_cache(fname)
+        if cached is not None:
+            (mtime, size, digest), data = cached
+            if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+                return data
+        source = file.read()
+    new_digest = hashlib.sha1(source).hexdigest()
+    if cached is None or digest != new_digest:
+        import yaml  # only needed here, and slow to import
+        data = yaml.safe_load(source)
+    _write_cache(fname, (stat.st_mtime_ns, stat.st_size, new_digest), data)
+    return data
+
+
+def _cache_fname(fname):
+    return fname + '.pickle'
+
+
+def _read_cache(fname):
+    """Returns (key, data) from the cache for `fname`, or None if there is
+    no usable cache"""
+    try:
+        with open(_cache_fname(fname), 'rb') as file:
+            version, key, data = pickle.load(file)
+    except Exception:  # missing, unreadable, or from an incompatible version
+        return None
+    if version != CACHE_VERSION:
+        return None
+    return key, data
+
+
+def _write_cache(fname, key, data):
+    try:
+        replace_file(_cache_fname(fname),
+                     pickle.dumps((CACHE_VERSION, key, data),
+                                  protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass  # read-only install or similar; loading still works, just slower